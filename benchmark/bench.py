@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# Offline benchmark of the gate commands
+#
+#
+# The MIT License (MIT)
+# Copyright (C) 2012 SUSE Linux Products GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+#
+# Runs the gate commands end to end against the stand-in commands (see
+# fake.py), which replay recorded outputs, so only the own overhead of
+# SMDBA is measured: scenarios, parsers and the orchestration.
+#
+# Usage:
+#   python benchmark/bench.py [--rows=N] [--latency=SECONDS] [--repeat=N] [--save]
+#
+#   --rows     Amount of rows in the repeated parts of the recordings. Default: 1000
+#   --latency  Seconds each stand-in command waits before the output. Default: 0
+#   --repeat   Runs of each command, the best is taken. Default: 3
+#   --save     Save the thresholds as three times of the current timings, at least 50ms.
+#
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from smdba import oraclegate
+from smdba import postgresqlgate
+from smdba.utils import TablePrint
+
+
+HOME = os.path.dirname(os.path.abspath(__file__))
+THRESHOLDS = os.path.join(HOME, 'thresholds.json')
+
+# Commands of each gate with the output, they must produce from the recordings.
+# Placeholder "%(last)s" is the last row of the repeated parts.
+COMMANDS = {
+    'oracle': [
+        ('db-status', 'online'),
+        ('listener-status', 'Instances:  1'),
+        ('space-overview', 'TS%(last)s '),
+        ('space-tables', 'RHNBENCH%(last)s '),
+        ('stats-overview', 'RHNEMPTY%(last)s'),
+        ('backup-list', 'TAG%(last)s_'),
+        ('backup-check', '%(rows)s available archive logs'),
+    ],
+    'postgresql': [
+        ('db-status', 'online'),
+        ('space-overview', 'db%(last)s '),
+        ('space-tables', 'rhnbench%(last)s '),
+        ('stats-overview', 'rhnempty%(last)s'),
+        ('backup-status', 'Backup status:     ON'),
+    ],
+}
+
+
+class Stage:
+    """
+    Temporary system with the stand-in commands, Oracle home and PostgreSQL data directory.
+    """
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp(prefix='smdba-bench.')
+        self.bin = os.path.join(self.root, 'bin')
+        self.ora_home = os.path.join(self.root, 'oracle', 'product', '11gR2', 'xe')
+        self.oratab = os.path.join(self.root, 'oratab')
+        self.pg_data = os.path.join(self.root, 'pgsql', 'data')
+
+        for path in [self.bin, os.path.join(self.ora_home, 'bin'), self.pg_data]:
+            os.makedirs(path)
+        for name in ['sudo', 'psql', 'pg_ctl', 'df', 'du']:
+            os.symlink(os.path.join(HOME, 'fake.py'), os.path.join(self.bin, name))
+        for name in ['sqlplus', 'rman', 'lsnrctl']:
+            os.symlink(os.path.join(HOME, 'fake.py'), os.path.join(self.ora_home, 'bin', name))
+
+        open(self.oratab, 'w').write("XE:%s:N\n" % self.ora_home)
+        open(os.path.join(self.pg_data, 'postmaster.pid'), 'w').write("%s\n%s\n" % (os.getpid(), self.pg_data))
+        open(os.path.join(self.pg_data, 'postgresql.conf'), 'w').write(
+            "archive_command = '/usr/bin/smdba-pgarchive --source \"%%p\" --destination \"%s/%%f\"'\n" % self.root)
+
+        os.environ['PATH'] = self.bin + ':' + os.environ.get('PATH', '')
+        os.environ['SMDBA_BENCH_PGDATA'] = self.pg_data
+
+
+    def get_gate(self, backend):
+        """
+        Get the gate of the backend, bound to the stage.
+        """
+        stage = self
+        if backend == 'oracle':
+            class BenchOracleGate(oraclegate.OracleGate):
+                ORATAB = stage.oratab
+            return BenchOracleGate({'db_name': 'XE', 'db_user': 'spacewalk'})
+
+        class BenchPgSQLGate(postgresqlgate.PgSQLGate):
+            def _get_sysconfig(self):
+                pass
+
+            def _get_pg_data(self):
+                self.config['pcnf_pg_data'] = stage.pg_data
+        return BenchPgSQLGate({'db_name': 'susemanager'})
+
+
+    def cleanup(self):
+        shutil.rmtree(self.root)
+
+
+def run(gate, command, repeat):
+    """
+    Run the command and return the best time in seconds and the output of the last run.
+    """
+    method = getattr(gate, "do_" + command.replace("-", "_"))
+    best = None
+    for idx in range(repeat):
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = tempfile.TemporaryFile()
+        start = time.time()
+        try:
+            result = method()
+            if result is not None:
+                print >> sys.stdout, result
+        finally:
+            output, sys.stdout, sys.stderr = sys.stdout, stdout, stderr
+        elapsed = time.time() - start
+        best = best is None and elapsed or min(best, elapsed)
+        output.seek(0)
+
+    return best, output.read()
+
+
+def main():
+    params = dict([(opt[2:] + "=").split("=")[:2] for opt in sys.argv[1:] if opt.startswith("--")])
+    os.environ['SMDBA_BENCH_ROWS'] = params.get('rows') or '1000'
+    os.environ['SMDBA_BENCH_LATENCY'] = params.get('latency') or '0'
+    repeat = int(params.get('repeat') or 3)
+    rows = int(os.environ['SMDBA_BENCH_ROWS'])
+
+    thresholds = os.path.exists(THRESHOLDS) and json.load(open(THRESHOLDS)) or {}
+    results = {}
+    table = [('Gate', 'Command', 'Best, ms', 'Limit, ms', 'Result',)]
+    failed = 0
+    stage = Stage()
+    try:
+        for backend in sorted(COMMANDS.keys()):
+            gate = stage.get_gate(backend)
+            for command, expected in COMMANDS[backend]:
+                key = "%s %s" % (backend, command)
+                limit = thresholds.get(key)
+                try:
+                    elapsed, output = run(gate, command, repeat)
+                    results[key] = int(elapsed * 1000)
+                    if output.find(expected % {'rows': rows, 'last': rows - 1}) == -1:
+                        status = 'WRONG'
+                    else:
+                        status = (limit is None or results[key] <= limit) and 'ok' or 'SLOW'
+                except (Exception, SystemExit):
+                    results[key] = None
+                    status = 'FAILED'
+                failed += status != 'ok'
+                table.append((backend, command, results[key] is not None and str(results[key]) or '--',
+                              limit is not None and str(limit) or '--', status,))
+    finally:
+        stage.cleanup()
+
+    print >> sys.stdout, TablePrint(table)
+    if 'save' in params:
+        json.dump(dict([(name, max(value * 3, 50)) for name, value in results.items() if value is not None]),
+                  open(THRESHOLDS, 'w'), indent=4, sort_keys=True, separators=(',', ': '))
+        print >> sys.stdout, "\nThresholds saved to", THRESHOLDS
+
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Stand-in for the external commands of the gates
+#
+#
+# The MIT License (MIT)
+# Copyright (C) 2012 SUSE Linux Products GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+#
+# Installed by the benchmark under the names of the real commands, like
+# sudo, psql, sqlplus, rman, lsnrctl, df and du. Replays the recordings
+# of the command, which match its input, after a configured latency.
+#
+
+import os
+import re
+import sys
+import time
+import subprocess
+
+
+RECORDINGS = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'recordings')
+
+
+def render(recording, match, rows):
+    """
+    Render the recording. Lines between "@@repeat" and "@@end" are repeated
+    the amount of rows, where "{n}" is the row number. "{1}" and so on are
+    the groups of the match and "{$NAME}" is the environment variable.
+    """
+    out = []
+    block = None
+    for line in recording.split("\n"):
+        if line == '@@repeat':
+            block = []
+        elif line == '@@end':
+            for idx in range(rows):
+                out.extend([bline.replace('{n}', str(idx)) for bline in block])
+            block = None
+        elif block is not None:
+            block.append(line)
+        else:
+            out.append(line)
+
+    out = '\n'.join(out)
+    out = re.sub(r'\{(\d+)\}', lambda ref: match.group(int(ref.group(1))) or '', out)
+    out = re.sub(r'\{\$(\w+)\}', lambda ref: os.environ.get(ref.group(1), ''), out)
+
+    return out
+
+
+def get_separator(tool, args, script):
+    """
+    Get the column separator, requested from the tool: "-A -F" of psql or
+    "set colsep" of SQL*Plus. Columns of the recordings are separated with "|".
+    """
+    if tool == 'psql' and '-A' in args:
+        return '-F' in args[:-1] and args[args.index('-F') + 1] or '|'
+    elif tool == 'sqlplus':
+        colsep = re.search(r"set colsep '([^']*)'", script, re.I)
+        return colsep and colsep.group(1) or ' '
+
+    return None
+
+
+def replay(tool, script, separator=None):
+    """
+    Print the first recording of the tool, which matches its input.
+    """
+    time.sleep(float(os.environ.get('SMDBA_BENCH_LATENCY', 0)))
+    path = os.path.join(RECORDINGS, tool)
+    if not os.path.isdir(path):
+        return
+
+    for name in sorted(os.listdir(path)):
+        recording = open(os.path.join(path, name)).read()
+        header, recording = recording.split("\n", 1)
+        match = re.search(header.split(" ", 1)[-1].strip(), script, re.I | re.S)
+        if header.startswith('@@match') and match:
+            out = render(recording, match, int(os.environ.get('SMDBA_BENCH_ROWS', 100)))
+            if separator is not None:
+                out = '\n'.join([separator.join([field.strip() for field in line.split('|')]) for line in out.split('\n')])
+            sys.stdout.write(out)
+            break
+
+
+def sudo(args):
+    """
+    Run the command without changing the user. Executables of the scripts,
+    which are stood in, are taken from the benchmark.
+    """
+    bindir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    while args and (args[0].startswith('-') or args[0].find('=') > -1):
+        opt = args.pop(0)
+        if opt in ['-u', '-g', '-nu']:
+            args.pop(0)
+        elif not opt.startswith('-'):
+            os.environ[opt.split('=', 1)[0]] = opt.split('=', 1)[1]
+
+    if os.path.basename(args[0]) in ['bash', 'sh']:
+        script = re.sub(r'/usr/bin/(\w+)', lambda exe: os.path.exists(os.path.join(bindir, exe.group(1)))
+                        and os.path.join(bindir, exe.group(1)) or exe.group(0), sys.stdin.read())
+        process = subprocess.Popen(args, stdin=subprocess.PIPE)
+        process.communicate(script.encode())
+        return process.returncode
+
+    if os.path.exists(os.path.join(bindir, os.path.basename(args[0]))):
+        args[0] = os.path.join(bindir, os.path.basename(args[0]))
+    os.execv(args[0], args)
+
+
+if __name__ == '__main__':
+    tool = os.path.basename(sys.argv[0])
+    if tool == 'sudo':
+        sys.exit(sudo(sys.argv[1:]))
+
+    script = ' '.join(sys.argv[1:])
+    if not sys.stdin.isatty():
+        script += '\n' + sys.stdin.read()
+    replay(tool, script, get_separator(tool, sys.argv[1:], script))
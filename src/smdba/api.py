@@ -0,0 +1,150 @@
+# Embeddable interface to the database gates
+#
+#
+# The MIT License (MIT)
+# Copyright (C) 2012 SUSE Linux Products GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import os
+import sys
+import threading
+from basegate import GateException
+from roller import Roller
+from utils import ThreadOutput
+
+
+DEFAULT_CONFIG = "/etc/rhn/rhn.conf"
+
+# Guards installing the per-thread streams in place of the process-wide ones
+_streams = threading.Lock()
+
+
+def read_config(path=DEFAULT_CONFIG):
+    """
+    Read database settings of the rhn config.
+    """
+    if not os.path.exists(path):
+        raise GateException("Cannot open configuration file: %s" % path)
+
+    config = {}
+    for line in open(path).readlines():
+        try:
+            key, value = line.replace(" ", "").strip().split("=", 1)
+            if key.startswith("db_"):
+                # Handling odd change in Spacewalk 1.7 where "db_name" could be URI
+                config[key] = ((key == "db_name") and value.startswith("//")) and value.split("/")[-1] or value
+        except ValueError:
+            pass
+
+    return config
+
+
+def _get_backend(config):
+    """
+    Import the gate module of the database backend, set in the config.
+    """
+    gate_name = "smdba." + config.get("db_backend", "unknown") + "gate"
+    try:
+        __import__(gate_name)
+    except ImportError:
+        raise GateException("Unknown database backend \"%s\"." % config.get("db_backend", "unknown"))
+
+    return sys.modules[gate_name]
+
+
+def get_gate(config):
+    """
+    Load and check the gate of the database backend, set in the config.
+    """
+    gate = _get_backend(config).getGate(config)
+    gate.check()
+
+    return gate
+
+
+def get_cluster_gates(config, names=None):
+    """
+    Load and check the gates of the database clusters on this host, set in the config.
+    Names are selecting some of the clusters. Returns list of (name, gate) tuples.
+    """
+    backend = _get_backend(config)
+    if not hasattr(backend, "getClusters"):
+        raise GateException("Database backend \"%s\" has no clusters." % config.get("db_backend"))
+
+    gates = backend.getClusters(config, names)
+    for name, gate in gates:
+        gate.check()
+
+    return gates
+
+
+def run(gate, method, *args, **params):
+    """
+    Run the gate method with the gate hooks around.
+    """
+    gate.startup()
+    result = getattr(gate, method)(*args, **params)
+    gate.finish()
+
+    return result
+
+
+def _get_thread_outputs():
+    """
+    Get the standard streams, which keep output of the threads apart.
+    They are installed once, threads without their own stream are
+    writing to the original ones.
+    """
+    _streams.acquire()
+    try:
+        for name in ['stdout', 'stderr']:
+            if not isinstance(getattr(sys, name), ThreadOutput):
+                setattr(sys, name, ThreadOutput(getattr(sys, name)))
+        return [sys.stdout, sys.stderr]
+    finally:
+        _streams.release()
+
+
+def execute(gate, command, args=(), params=None, output=None):
+    """
+    Run the command by its console name, like "db-status".
+
+    Returns the Result of the command or None, if the command has no result.
+    Failures are raised as GateException or its subclasses.
+    Messages and progress are written to the output file object or discarded.
+    Output of other threads of the process is not affected.
+    """
+    method = "do_" + command.replace("-", "_")
+    if not gate.get_gate_commands().get(method):
+        raise GateException("Unknown command \"%s\"." % command)
+
+    null = output is None and open(os.devnull, "w") or None
+    streams = _get_thread_outputs()
+    for stream in streams:
+        stream.attach(output or null)
+    try:
+        return run(gate, method, *args, **(params or {}))
+    finally:
+        Roller.stop_all(owner=threading.current_thread())
+        for stream in streams:
+            stream.detach()
+        if null:
+            null.close()
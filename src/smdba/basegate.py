@@ -27,19 +27,71 @@
 
 import os
 import sys
+import re
+import time
+import signal
+import select
 import textwrap
 import subprocess
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE
+from roller import wait_for
+from exporter import Exporter
+import utils
 
 
 class GateException(Exception): pass
 
+class AccessDeniedException(GateException): pass
+
+class NotReadyException(GateException): pass
+
+class TimeoutException(GateException): pass
+
+class BackupException(GateException): pass
+
+class UnderlyingException(GateException):
+    """
+    Errors, reported by the underlying database tools.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        GateException.__init__(self, "Underlying error:\n" + "\n".join(errors))
+
 class BaseGate:
     """
     Gate of tools for all supported databases.
     """
 
     debug = False
+    tracer = None
+    _sudo_granted = ()
+
+    # Timeouts in seconds of the external commands by their names, 0 means no limit.
+    # Only the commands, which are known to be short, are limited by default:
+    # killing a copy or a maintenance statement halfway is worse than waiting.
+    TIMEOUTS = {
+        'default': 0,
+        'df': 30,
+        'lsnrctl': 120,
+        'pg_ctl': 600,
+    }
+
+    # Seconds without any output of a command, after which it is reported as stalled.
+    STALL_WARNING = 300
+
+    # Seconds to wait for the terminated command to exit, before it is killed.
+    TERMINATE_TIMEOUT = 5
+
+    # Messages of sudo, refusing to run the command
+    SUDO_DENIED = re.compile(r'^sudo: .*(password is required|not allowed|not in the sudoers)|^Sorry, user .* is not allowed')
+
+    # Separator of the columns in the output of the scenarios (ASCII unit separator).
+    # SQL*Plus scenarios are setting it with "set colsep '@colsep'".
+    FIELD_SEPARATOR = '\x1f'
+
+    # Commands, which are never running at the same time on the host, as they compete for I/O.
+    EXCLUSIVE = ['do_backup_hot', 'do_backup_restore', 'do_backup_purge',
+                 'do_backup_logical', 'do_backup_logical_restore', 'do_space_reclaim', 'do_stats_refresh', 'do_system_check']
 
 
     # XXX: This is a stub method that currently is OK to have here.
@@ -64,7 +116,7 @@ class BaseGate:
         apache_httpd = initd + (os.path.exists(initd + '/httpd') and '/httpd' or '/apache2')        
         #print "Apache: " + os.popen(apache_httpd + " status").read()
 
-        return os.popen(tomcat + " status 2>&1").read().strip().find('dead') == -1
+        return self.shell_output(tomcat + " status 2>&1").strip().find('dead') == -1
 
 
     def get_scn(self, name):
@@ -115,7 +167,9 @@ class BaseGate:
             scenario.append("EXIT;")
             scenario.append("EOF")
         elif target in ['psql']:
-            scenario.append(("cat - << EOF | " + executable + " -t --pset footer=off " + self.config.get('db_name', '')).strip())
+            if self.config.get('cluster_port'):
+                executable += " -p " + self.config['cluster_port']
+            scenario.append(("cat - << EOF | " + executable + " -t -A -F $'\\037' --pset footer=off " + self.config.get('db_name', '')).strip())
             scenario.append("@scenario")
             scenario.append("EOF")
         
@@ -127,12 +181,12 @@ class BaseGate:
         return '\n'.join(scenario)
 
     
-    def call_scenario(self, scenario, target='sqlplus', login=None, **variables):
+    def _get_scenario_call(self, scenario, target='sqlplus', login=None, **variables):
         """
-        Call scenario in SQL*Plus.
-        Returns stdout and stderr.
+        Get script of the scenario and the user to run it.
         """
         template = self.get_scenario_template(target=target, login=login).replace('@scenario', self.get_scn(scenario).read().replace('$', '\$'))
+        variables.setdefault('colsep', self.FIELD_SEPARATOR)
 
         if variables:
             for k_var, v_var in variables.items():
@@ -151,24 +205,217 @@ class BaseGate:
         #print template
         #print "=============="
 
+        return template, user
+
+
+    def call_scenario(self, scenario, target='sqlplus', login=None, **variables):
+        """
+        Call scenario in SQL*Plus.
+        Returns stdout and stderr.
+        """
+        template, user = self._get_scenario_call(scenario, target=target, login=login, **variables)
         return self.syscall("sudo", template, None, "-u", user, "/bin/bash")
 
 
-    def syscall(self, command, input=None, daemon=None, *params):
+    def call_scenario_lines(self, scenario, target='sqlplus', login=None, **variables):
+        """
+        Call scenario, yielding its output lines as they arrive.
+        See syscall_lines.
+        """
+        template, user = self._get_scenario_call(scenario, target=target, login=login, **variables)
+        return self.syscall_lines("sudo", template, "-u", user, "/bin/bash")
+
+
+    def syscall(self, command, input=None, daemon=None, *params, **options):
         """
         Call an external system command.
+        Options are the same as of syscall_lines.
         """
-        stdout, stderr = Popen([command] + list(params), 
-                               stdout=PIPE, 
-                               stdin=PIPE, 
-                               stderr=STDOUT,
-                               env=os.environ).communicate(input=input)
-        if not stderr:
-            stderr = ""
-        stderr += self.extract_errors(stdout)
+        stdout = '\n'.join([line for stream, line in self._execute([command] + list(params), input, {}, **options)])
+        stderr = self.extract_errors(stdout)
         return stdout and stdout.strip() or '', stderr and stderr.strip() or ''
 
 
+    def syscall_lines(self, command, input=None, *params, **options):
+        """
+        Call an external system command, yielding its output as it arrives.
+        Yields tuples of the stream name ("stdout" or "stderr") and the line,
+        so the output is never kept in memory as a whole.
+
+        Options:
+          name:    name of the command for its timeout, if it is not the executable.
+          timeout: seconds to wait for the command, overrides the configured one.
+          cwd:     working directory of the command.
+        """
+        return self._execute([command] + list(params), input, {}, **options)
+
+
+    def shell_output(self, command, name=None, timeout=None):
+        """
+        Call a shell command line and return its standard output.
+        """
+        return '\n'.join([line for stream, line in self._execute(['/bin/sh', '-c', command], None, {},
+                                                                   name=name or self.get_command_name(command.split()),
+                                                                   timeout=timeout)
+                          if stream == 'stdout'])
+
+
+    def shell_call(self, command, name=None, cwd=None, timeout=None):
+        """
+        Call a shell command line, passing its output to the console.
+        Returns the exit status.
+        """
+        result = {}
+        for stream, line in self._execute(['/bin/sh', '-c', command], None, result, name=name or self.get_command_name(command.split()),
+                                          cwd=cwd, timeout=timeout):
+            print >> (stream == 'stdout' and sys.stdout or sys.stderr), line
+
+        return result['returncode']
+
+
+    def get_command_name(self, args, input=None):
+        """
+        Get name of the command, as it is known in the timeouts: executable
+        behind sudo and its options, or the target of the scenario script.
+        """
+        args = list(args)
+        if os.path.basename(args[0]) == 'sudo':
+            args.pop(0)
+            while args and (args[0].startswith('-') or args[0].find('=') > -1):
+                if args.pop(0) in ['-u', '-g']:
+                    args = args[1:]
+
+        name = args and os.path.basename(args[0]) or 'default'
+        if name in ['bash', 'sh'] and input:
+            target = re.search(r'^cat - << EOF \| (\S+)', input, re.M)
+            if target:
+                name = os.path.basename(target.group(1))
+
+        return name
+
+
+    def get_timeout(self, name):
+        """
+        Get timeout in seconds of the command by its name.
+        It is set as "db_timeout_<name>" in the configuration, 0 means no limit.
+        """
+        config = getattr(self, 'config', None) or {}
+        return int(config.get('db_timeout_' + name, self.TIMEOUTS.get(name, config.get('db_timeout', self.TIMEOUTS['default']))))
+
+
+    def _terminate(self, process):
+        """
+        Terminate the whole process group of the command.
+        """
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(process.pid, sig)
+            except OSError:
+                pass # Already gone
+            if wait_for(lambda: process.poll() is not None, timeout=self.TERMINATE_TIMEOUT):
+                break
+
+
+    def _execute(self, args, input, result, name=None, timeout=None, cwd=None):
+        """
+        Run the command in its own process group, yielding its output lines.
+        The command is terminated, if it runs longer than its timeout, and a
+        warning with its last output is logged, if it has no output for a while.
+        Exit status is put to the result dictionary.
+        """
+        name = name or self.get_command_name(args, input)
+        if timeout is None:
+            timeout = self.get_timeout(name)
+        stall = int((getattr(self, 'config', None) or {}).get('db_stall_warning', self.STALL_WARNING))
+
+        trace = self.tracer and self.tracer.call(name, args)
+        output = 0
+        process = Popen(args, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=os.environ, cwd=cwd, preexec_fn=os.setpgrp)
+        streams = {process.stdout.fileno(): 'stdout', process.stderr.fileno(): 'stderr'}
+        buffers = dict.fromkeys(streams.keys(), '')
+        pending = input or ''
+        if not pending:
+            process.stdin.close()
+
+        started = last_output = time.time()
+        last_line = ''
+        sudo = os.path.basename(args[0]) == 'sudo'
+        denied = None
+        try:
+            while streams:
+                now = time.time()
+                if timeout and now - started >= timeout:
+                    self._terminate(process)
+                    raise TimeoutException("Command \"%s\" did not finish in %s seconds and has been terminated.%s"
+                                        % (name, timeout, last_line and "\nLast output: " + last_line or ""))
+                if stall and now - last_output >= stall:
+                    print >> sys.stderr, "WARNING: Command \"%s\" (PID %s) has no output for %s seconds.%s" \
+                        % (name, process.pid, int(now - last_output), last_line and " Last output: " + last_line or "")
+                    last_output = now
+
+                # Daemons, started by the command, may keep its output open after it exits.
+                exited = process.poll() is not None
+                deadlines = filter(None, [timeout and started + timeout, stall and last_output + stall])
+                wait = not exited and max(min(deadlines + [now + 1]) - now, 0.01) or 0
+                rlist, wlist, xlist = select.select(streams.keys(), pending and [process.stdin.fileno()] or [], [], wait)
+                if exited and not rlist:
+                    break
+                if wlist:
+                    try:
+                        pending = pending[os.write(wlist[0], pending[:select.PIPE_BUF]):]
+                    except OSError:
+                        pending = '' # Command does not read the input anymore
+                    if not pending:
+                        process.stdin.close()
+
+                for fd in rlist:
+                    chunk = os.read(fd, 0x10000)
+                    if not chunk:
+                        if buffers[fd]:
+                            yield streams[fd], buffers[fd]
+                        del streams[fd]
+                        continue
+
+                    last_output = time.time()
+                    output += len(chunk)
+                    lines = re.split('\r\n?|\n', buffers[fd] + chunk)
+                    buffers[fd] = lines.pop()
+                    for line in lines:
+                        last_line = line.strip() or last_line
+                        if sudo and not denied and streams[fd] == 'stderr' and self.SUDO_DENIED.search(line):
+                            denied = line.strip()
+                        yield streams[fd], line
+            result['returncode'] = process.wait()
+            if denied and result['returncode']:
+                self.forget_sudo()
+                raise AccessDeniedException("Access denied via sudo: %s" % denied)
+        finally:
+            if process.poll() is None:
+                self._terminate(process) # Caller has stopped reading
+            process.wait()
+            if trace:
+                trace(output, process.returncode)
+
+
+    def get_rows(self, stdout, *types):
+        """
+        Parse output of the scenario into tuples of typed values.
+        Types are converting the columns, like str or long. Lines of other
+        width, like messages, and values, which cannot be converted, are skipped.
+        """
+        rows = []
+        for line in stdout.split("\n"):
+            fields = line.split(self.FIELD_SEPARATOR)
+            if len(fields) != len(types):
+                continue
+            try:
+                rows.append(tuple([convert(field.strip()) for convert, field in zip(types, fields)]))
+            except ValueError:
+                pass
+
+        return rows
+
+
     def get_gate_commands(self):
         """
         Gate commands inspector.
@@ -207,6 +454,121 @@ class BaseGate:
         raise GateException("No check implemented for this gate.")
 
 
+    def get_config_files(self):
+        """
+        Files, which the gate configuration is read from.
+        Resident console reloads the gate, once any of them is changed.
+        """
+        return []
+
+
+    def get_collectors(self):
+        """
+        Stub for the metric collectors of the gate.
+        """
+        raise GateException("No metrics implemented for this gate.")
+
+
+    def do_metrics_export(self, *args, **params):
+        """
+        Export database, backup and space health metrics in Prometheus format.
+        @help
+        --port=<value>\tServe metrics over HTTP on the local port.
+        --textfile=<path>\tWrite metrics to the file for the textfile collector.
+        once\t\t\tCollect all metrics once, write the textfile and exit.
+        """
+        port = params.get('port')
+        textfile = params.get('textfile')
+        if not port and not textfile:
+            raise GateException("Port or textfile has to be specified.")
+        if port:
+            try:
+                port = int(port)
+            except ValueError:
+                raise GateException("Port should be an integer.")
+        if textfile and not os.path.isdir(os.path.dirname(os.path.abspath(textfile))):
+            raise GateException("Directory of the textfile \"%s\" does not exist." % textfile)
+
+        exporter = Exporter(self.get_collectors())
+        if 'once' in args:
+            if not textfile:
+                raise GateException("Textfile has to be specified to collect metrics once.")
+            exporter.refresh()
+            exporter.write(textfile)
+        else:
+            print >> sys.stdout, "Exporting metrics%s%s" % (port and " on 127.0.0.1:%s" % port or "",
+                                                           textfile and " to %s" % textfile or "")
+            sys.stdout.flush()
+            exporter.serve(port=port, textfile=textfile)
+
+
+    def get_state_dir(self):
+        """
+        Stub for the directory, where the gate keeps its own state data.
+        """
+        raise GateException("No state directory implemented for this gate.")
+
+
+    def load_state(self, name):
+        """
+        Load previously saved state data by name as a dictionary of strings.
+        """
+        state = {}
+        path = os.path.join(self.get_state_dir(), name + ".state")
+        if os.path.exists(path):
+            for line in open(path).readlines():
+                line = line.strip()
+                if not line or line.startswith('#') or (line.find('=') == -1):
+                    continue
+                key, value = map(lambda el:el.strip(), line.split('=', 1))
+                state[key] = value
+
+        return state
+
+
+    def save_state(self, name, **data):
+        """
+        Save state data by name.
+        """
+        path = self.get_state_dir()
+        if not os.path.exists(path):
+            os.makedirs(path, 0700)
+
+        state = open(os.path.join(path, name + ".state"), 'w')
+        state.write("# Saved by SMDBA at %s. Do not edit.\n" % time.ctime())
+        for key in sorted(data.keys()):
+            state.write("%s = %s\n" % (key, data[key]))
+        state.close()
+
+
+    def get_checked(self, name, paths, check):
+        """
+        Result of the check as a string, remembered between the runs until
+        any of the files at the paths, like the binaries, is changed.
+        Failed check raises an exception and is not remembered.
+        """
+        signature = ' '.join(["%s:%s" % (path, os.path.exists(path) and int(os.path.getmtime(path)) or '-')
+                              for path in paths])
+        try:
+            state = self.load_state('checks')
+        except (GateException, KeyError, IOError, OSError):
+            state = None # No state directory yet
+
+        if state and state.get(name + '.signature') == signature:
+            return state.get(name)
+
+        value = str(check())
+        if state is not None:
+            state[name] = value
+            state[name + '.signature'] = signature
+            try:
+                self.save_state('checks', **state)
+            except (IOError, OSError):
+                pass # Checked again next time
+
+        return value
+
+
     def size_pretty(self, size, int_only=False, no_whitespace=False):
         """
         Make pretty size from bytes to other metrics.
@@ -247,11 +609,58 @@ class BaseGate:
     def check_sudo(self, uid):
         """
         Check if UID has sudo permission.
+        Granted permission is remembered, while the gate is alive.
         """
-        sudo = os.popen("which sudo").read().strip()
-        stdout, stderr = self.syscall(sudo, "", None, "-nu", uid, "-S", "true", "/bin/bash")
-        if stdout + stderr:
-            raise GateException("Access denied to UID \"%s\" via sudo." % uid);
+        if uid in self._sudo_granted:
+            return
+
+        sudo = utils.which("sudo")
+        if not sudo:
+            raise AccessDeniedException("Cannot find sudo.")
+
+        def check():
+            stdout, stderr = self.syscall(sudo, "", None, "-nu", uid, "-S", "true", "/bin/bash")
+            if stdout + stderr:
+                raise AccessDeniedException("Access denied to UID \"%s\" via sudo." % uid);
+            return True
+
+        # Rules from a directory service, like LDAP or SSSD, can change any time
+        if self.get_sudoers_sources() != ['files']:
+            check()
+        else:
+            paths = [sudo, "/etc/sudoers", "/etc/sudoers.d", "/etc/nsswitch.conf"]
+            try:
+                paths += [os.path.join("/etc/sudoers.d", name) for name in sorted(os.listdir("/etc/sudoers.d"))]
+            except OSError:
+                pass # No drop-in files
+            self.get_checked("sudo-%s-%s" % (os.getuid(), uid), paths, check)
+        self._sudo_granted += (uid,)
+
+
+    def get_sudoers_sources(self):
+        """
+        Sources of the sudo rules, set in /etc/nsswitch.conf.
+        """
+        sources = ['files']
+        if os.path.exists("/etc/nsswitch.conf"):
+            for line in open("/etc/nsswitch.conf").readlines():
+                line = line.split('#')[0].strip()
+                if line.startswith("sudoers:"):
+                    sources = [source for source in line.split(":", 1)[1].split() if not source.startswith('[')]
+
+        return sources
+
+
+    def forget_sudo(self):
+        """
+        Forget the granted sudo permissions, so they are checked again.
+        """
+        self._sudo_granted = ()
+        try:
+            state = self.load_state('checks')
+            self.save_state('checks', **dict([(key, value) for key, value in state.items() if not key.startswith('sudo-')]))
+        except (GateException, KeyError, IOError, OSError):
+            pass # No state directory yet
 
 
     def startup(self):
@@ -279,25 +688,28 @@ class BaseGate:
 
         out = []
         for line in filter(None, str(stdout).replace("\\n", "\n").split("\n")):
-            if line.lower().startswith("ora-") or line.lower().startswith("rman-"):
-                if not line.find("===") > -1: # Skip ugly Oracle error emphasis
-                    out += textwrap.wrap(line.strip())
+            out += self.extract_line_errors(line)
 
         return '\n'.join(out)
 
 
+    def extract_line_errors(self, line):
+        """
+        Extract errors from a single line of the RMAN and SQLPlus output.
+        Returns a list of wrapped error lines.
+        """
+        if line.lower().startswith("ora-") or line.lower().startswith("rman-"):
+            if not line.find("===") > -1: # Skip ugly Oracle error emphasis
+                return textwrap.wrap(line.strip())
+
+        return []
+
+
     def to_stderr(self, stderr):
         """
-        Format an error output to STDERR and terminate everything at once.
+        Raise an error output of the underlying tools, if there is any.
         """
         if not (stderr + "").strip():
             return False
 
-        out = []
-        for line in filter(None, str(stderr).replace("\\n", "\n").split("\n")):
-            out.append("  " + line.strip())
-        print >> sys.stderr, "\nError:\n" + ("-" * 80)
-        print >> sys.stderr, "\n".join(out)
-        print >> sys.stderr, "-" * 80
-
-        sys.exit(1)
+        raise UnderlyingException([line.strip() for line in filter(None, str(stderr).replace("\\n", "\n").split("\n"))])
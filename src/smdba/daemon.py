@@ -0,0 +1,209 @@
+# Resident console, serving commands over a local Unix socket
+#
+#
+# The MIT License (MIT)
+# Copyright (C) 2012 SUSE Linux Products GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import os
+import sys
+import json
+import socket
+import threading
+import SocketServer
+
+# Seconds to wait for the daemon to take the command, before running it here.
+ACCEPT_TIMEOUT = 2
+
+
+class StreamWriter:
+    """
+    File-like stream, which forwards everything written to the client.
+    """
+
+    def __init__(self, connection, stream):
+        self.connection = connection
+        self.stream = stream
+
+
+    def write(self, data):
+        """
+        Send the data as a frame of the stream.
+        """
+        if not data or self.connection is None:
+            return
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        try:
+            self.connection.sendall(json.dumps({'stream': self.stream, 'data': data}) + "\n")
+        except socket.error:
+            # Client is gone, but the command is not interrupted in the middle.
+            self.connection = None
+
+
+    def flush(self):
+        pass
+
+
+    def isatty(self):
+        return False
+
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Runs one command line and streams its output back.
+    """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline() or '{}')
+        if not request.get('argv'):
+            return
+
+        # Another command is running: let the client run this one itself.
+        if not self.server.busy.acquire(False):
+            self.wfile.write(json.dumps({'busy': True}) + "\n")
+            return
+
+        try:
+            self.wfile.write(json.dumps({'accepted': True}) + "\n")
+            self.run(request)
+        finally:
+            self.server.busy.release()
+
+
+    def run(self, request):
+        """
+        Run the command line of the request.
+        """
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = StreamWriter(self.connection, 'stdout')
+        sys.stderr = StreamWriter(self.connection, 'stderr')
+        try:
+            try:
+                os.chdir(request.get('cwd') or '/')
+                code = self.server.runner([arg.encode('utf-8') for arg in request['argv']])
+            except SystemExit, ex:
+                code = ex.code
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+        try:
+            self.wfile.write(json.dumps({'exit': code or 0}) + "\n")
+        except socket.error:
+            pass
+
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serves commands one by one, since the gates are not thread-safe.
+    Requests, arriving while a command is running, are answered as busy.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, runner):
+        """
+        Runner is a function, which takes the command line and returns the exit code.
+        """
+        if os.path.exists(path):
+            if ping(path):
+                raise Exception("Daemon is already running at %s" % path)
+            os.unlink(path) # Left after a crash
+
+        self.runner = runner
+        self.busy = threading.Lock()
+        umask = os.umask(0077) # Only the owner can send commands
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+
+def _connect(path):
+    """
+    Connect to the daemon socket or return None if it is not served.
+    """
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    return sock
+
+
+def ping(path):
+    """
+    Check if the daemon is serving at the path.
+    """
+    sock = _connect(path)
+    if sock:
+        sock.close()
+
+    return sock is not None
+
+
+def forward(path, argv):
+    """
+    Run the command line in the daemon, streaming its output to this console.
+    Returns exit code of the command or None, if the daemon is not available
+    or busy with another command.
+    """
+    sock = _connect(path)
+    if not sock:
+        return None
+
+    try:
+        sock.settimeout(ACCEPT_TIMEOUT)
+        try:
+            sock.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}) + "\n")
+            reply = sock.makefile()
+            if not json.loads(reply.readline() or '{}').get('accepted'):
+                return None
+        except (socket.error, ValueError):
+            return None
+        sock.settimeout(None)
+
+        for line in reply:
+            frame = json.loads(line)
+            if 'exit' in frame:
+                return frame['exit']
+            stream = getattr(sys, frame['stream'])
+            stream.write(frame['data'].encode('utf-8'))
+            stream.flush()
+    finally:
+        sock.close()
+
+    print >> sys.stderr, "Daemon has closed the connection unexpectedly."
+    return 1
@@ -0,0 +1,220 @@
+# Metrics of the database health in Prometheus text format
+#
+#
+# The MIT License (MIT)
+# Copyright (C) 2012 SUSE Linux Products GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import os
+import sys
+import time
+import threading
+import BaseHTTPServer
+
+
+# Metric name: (type, help)
+METRICS = {
+    'smdba_database_up': ('gauge', 'Database is running and accepts connections.'),
+    'smdba_listener_up': ('gauge', 'Database listener is running.'),
+    'smdba_backup_enabled': ('gauge', 'Archiving for the hot backup is turned on.'),
+    'smdba_backup_age_seconds': ('gauge', 'Seconds since the last full backup has finished.'),
+    'smdba_archive_lag_seconds': ('gauge', 'Seconds since the last WAL segment or redo log has been archived.'),
+    'smdba_archive_bytes': ('gauge', 'Size of the archived WAL segments or redo logs, kept for the backup.'),
+    'smdba_archive_rate_bytes': ('gauge', 'Archiving rate in bytes per second.'),
+    'smdba_filesystem_free_bytes': ('gauge', 'Free space of the filesystem.'),
+    'smdba_tablespace_size_bytes': ('gauge', 'Size of the tablespace.'),
+    'smdba_tablespace_usage_percent': ('gauge', 'Used space of the tablespace.'),
+    'smdba_stats_stale_tables': ('gauge', 'Tables with stale statistics.'),
+    'smdba_stats_empty_tables': ('gauge', 'Tables without statistics.'),
+    'smdba_live_tuples': ('gauge', 'Live rows of all user tables.'),
+    'smdba_dead_tuples': ('gauge', 'Dead rows of all user tables, not yet reclaimed by vacuum.'),
+    'smdba_collector_success': ('gauge', 'Last refresh of the collector has succeeded.'),
+    'smdba_collector_duration_seconds': ('gauge', 'Time taken by the last refresh of the collector.'),
+    'smdba_collector_age_seconds': ('gauge', 'Seconds since the last successful refresh of the collector.'),
+}
+
+
+class Collector:
+    """
+    Cached samples of a group of metrics, refreshed once their interval has passed.
+    """
+
+    def __init__(self, name, interval, collect):
+        """
+        Collect is a function, returning (metric, labels, value) samples.
+        """
+        self.name = name
+        self.interval = interval
+        self.collect = collect
+        self.samples = []
+        self.checked = None
+        self.refreshed = None
+        self.duration = 0
+        self.success = False
+
+
+    def is_due(self, now):
+        return self.checked is None or now - self.checked >= self.interval
+
+
+    def refresh(self):
+        """
+        Refresh the samples. Samples of the last successful refresh are kept on failure.
+        """
+        start = time.time()
+        try:
+            self.samples = list(self.collect())
+            self.success = True
+            self.refreshed = time.time()
+        except Exception, ex:
+            self.success = False
+            print >> sys.stderr, "Collector \"%s\" has failed: %s" % (self.name, str(ex).strip())
+        self.checked = time.time()
+        self.duration = self.checked - start
+
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the last rendered metrics, so scrapes never wait for the database.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        text = self.server.exporter.text
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+    def log_message(self, format, *args):
+        pass # Scrapes are not worth a line each
+
+
+
+class Exporter:
+    """
+    Metrics of the collectors in Prometheus text format.
+    """
+
+    def __init__(self, collectors):
+        self.collectors = collectors
+        self.text = ""
+
+
+    def refresh(self):
+        """
+        Refresh collectors, which are due. Returns True, if any was refreshed.
+        Messages of the gate commands are not shown.
+        """
+        due = [collector for collector in self.collectors if collector.is_due(time.time())]
+        if not due:
+            return False
+
+        null = open(os.devnull, 'w')
+        stdout, sys.stdout = sys.stdout, null
+        try:
+            for collector in due:
+                collector.refresh()
+        finally:
+            sys.stdout = stdout
+            null.close()
+        self.text = self.render()
+
+        return True
+
+
+    def _escape(self, value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+    def _format(self, name, labels, value):
+        labels = labels and ('{' + ','.join(['%s="%s"' % (key, self._escape(labels[key]))
+                                             for key in sorted(labels.keys())]) + '}') or ''
+        return "%s%s %s" % (name, labels, repr(float(value)))
+
+
+    def render(self):
+        """
+        Render all samples, grouped by the metric.
+        """
+        samples = {}
+        now = time.time()
+        for collector in self.collectors:
+            for name, labels, value in collector.samples:
+                samples.setdefault(name, []).append((labels, value))
+            if collector.checked is not None:
+                labels = {'collector': collector.name}
+                samples.setdefault('smdba_collector_success', []).append((labels, int(collector.success)))
+                samples.setdefault('smdba_collector_duration_seconds', []).append((labels, round(collector.duration, 3)))
+                if collector.refreshed is not None:
+                    samples.setdefault('smdba_collector_age_seconds', []).append((labels, int(now - collector.refreshed)))
+
+        out = []
+        for name in sorted(samples.keys()):
+            mtype, mhelp = METRICS.get(name, ('untyped', name))
+            out.append("# HELP %s %s" % (name, mhelp))
+            out.append("# TYPE %s %s" % (name, mtype))
+            for labels, value in samples[name]:
+                out.append(self._format(name, labels, value))
+
+        return '\n'.join(out) + '\n'
+
+
+    def write(self, path):
+        """
+        Write the metrics atomically, so the textfile collector never reads a half of it.
+        """
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        fh = open(tmp, 'w')
+        try:
+            fh.write(self.text)
+        finally:
+            fh.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+
+
+    def serve(self, port=None, textfile=None):
+        """
+        Keep refreshing the collectors, serving the metrics on the local port
+        and writing them to the textfile.
+        """
+        self.refresh()
+        if textfile:
+            self.write(textfile)
+
+        if port:
+            server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), Handler)
+            server.exporter = self
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            time.sleep(1)
+            if self.refresh() and textfile:
+                self.write(textfile)
@@ -27,13 +27,16 @@
 
 from basegate import BaseGate
 from basegate import GateException
+from basegate import NotReadyException
+from basegate import BackupException
 from roller import Roller
-from utils import TablePrint
+from roller import Progress
+from exporter import Collector
+from utils import Result
 
 import os
 import sys
 import re
-import time
 import utils
 import random
 
@@ -135,63 +138,78 @@ class OracleGate(BaseGate):
         roller.start()
         print >> sys.stdout, "Getting available backups:\t",
 
-        class InfoNode:pass
         infoset = []
-        stdout, stderr = self.call_scenario('rman-list-backups', target='rman')
-        self.to_stderr(stderr)
+        errors = []
+        chunk = []
+
+        # Output is parsed by backup sets as it arrives, since it grows with the amount of backups.
+        for stream, line in self.call_scenario_lines('rman-list-backups', target='rman'):
+            errors += self.extract_line_errors(line)
+            if line.startswith('='):
+                infoset, chunk = [], []
+            elif line.find('BS Key') > -1:
+                infoset += filter(None, [self._parse_backup_set(chunk)])
+                chunk = [line.split('BS Key', 1)[-1]]
+            else:
+                chunk.append(line)
+        infoset += filter(None, [self._parse_backup_set(chunk)])
+        self.to_stderr('\n'.join(errors))
 
         roller.stop("finished")
-        time.sleep(1)
 
-        if stdout:
-            for chunk in filter(None, [re.sub('=+', '', c).strip() for c in stdout.split("\n=")[-1].split('BS Key')]):
-                try:
-                    info = InfoNode()
-                    info.files = []
-                    piece_chnk, files_chnk = chunk.split('List of Datafiles')
-                    # Get backup place
-                    for line in [l.strip() for l in piece_chnk.split("\n")]:
-                        if line.lower().startswith('piece name'):
-                            info.backup = line.split(" ")[-1]
-                        if line.lower().find('status') > -1:
-                            status_line = filter(None, line.replace(':', '').split("Status")[-1].split(" "))
-                            if len(status_line) ==  5:
-                                info.status = status_line[0]
-                                info.compression = status_line[2]
-                                info.tag = status_line[4]
-
-                    # Get the list of files
-                    cutoff = True
-                    for line in [l.strip() for l in files_chnk.split("\n")]:
-                        if line.startswith('-'):
-                            cutoff = None
+        result = Result([('backup', 'Name'), ('type', 'Type'), ('date', 'Date'), ('file', 'File')])
+        for info in infoset:
+            for dbf in info.files:
+                result.append(info.backup, dbf.type, dbf.date, dbf.file)
+
+        return result
+
+
+    def _parse_backup_set(self, lines):
+        """
+        Parse lines of the backup set from the RMAN backup list.
+        """
+        class InfoNode:pass
+
+        chunk = re.sub('=+', '', '\n'.join(lines)).strip()
+        if not chunk:
+            return None
+
+        try:
+            info = InfoNode()
+            info.files = []
+            piece_chnk, files_chnk = chunk.split('List of Datafiles')
+            # Get backup place
+            for line in [l.strip() for l in piece_chnk.split("\n")]:
+                if line.lower().startswith('piece name'):
+                    info.backup = line.split(" ")[-1]
+                if line.lower().find('status') > -1:
+                    status_line = filter(None, line.replace(':', '').split("Status")[-1].split(" "))
+                    if len(status_line) ==  5:
+                        info.status = status_line[0]
+                        info.compression = status_line[2]
+                        info.tag = status_line[4]
+
+            # Get the list of files
+            cutoff = True
+            for line in [l.strip() for l in files_chnk.split("\n")]:
+                if line.startswith('-'):
+                    cutoff = None
+                    continue
+                else:
+                    line = filter(None, line.split(" "))
+                    if len(line) > 4:
+                        if line[0] == 'File':
                             continue
-                        else:
-                            line = filter(None, line.split(" "))
-                            if len(line) > 4:
-                                if line[0] == 'File':
-                                    continue
-                                dbf = InfoNode()
-                                dbf.type = line[1]
-                                dbf.file = line[-1]
-                                dbf.date = line[-2]
-                                info.files.append(dbf)
-                    infoset.append(info)
-                except:
-                    print >> sys.stderr, "No backup snapshots available."
-                    sys.exit(1)
-
-            # Display backup data
-            if (infoset):
-                print >> sys.stdout, "Backups available:\n"
-                for info in infoset:
-                    print >> sys.stdout, "Name:\t", info.backup
-                    print >> sys.stdout, "Files:"
-                    for dbf in info.files:
-                        print >> sys.stdout, "\tType:", dbf.type,
-                        print >> sys.stdout, "\tDate:", dbf.date,
-                        print >> sys.stdout, "\tFile:", dbf.file
-                    print >> sys.stdout
+                        dbf = InfoNode()
+                        dbf.type = line[1]
+                        dbf.file = line[-1]
+                        dbf.date = line[-2]
+                        info.files.append(dbf)
+        except:
+            raise BackupException("No backup snapshots available.")
+
+        return info
 
             
     def do_backup_purge(self, *args, **params):
@@ -207,11 +225,8 @@ class OracleGate(BaseGate):
         info = self.get_backup_info()
         if not len(info):
             roller.stop("failed")
-            time.sleep(1)
-            print >> sys.stderr, "No backup snapshots available."
-            sys.exit(1)
+            raise BackupException("No backup snapshots available.")
         roller.stop("finished")
-        time.sleep(1)
 
         print >> sys.stdout, "Removing %s backup%s:\t" % (len(info), len(info) > 1 and 's' or ''),
         roller = Roller()
@@ -219,11 +234,9 @@ class OracleGate(BaseGate):
         stdout, stderr = self.call_scenario('rman-backup-purge', target='rman')
         if stderr:
             roller.stop("failed")
-            time.sleep(1)
             self.to_stderr(stderr)
         
         roller.stop("finished")
-        time.sleep(1)
 
 
     def _backup_rotate(self):
@@ -239,12 +252,22 @@ class OracleGate(BaseGate):
 
         if stderr:
             roller.stop("failed")
-            time.sleep(1)
             self.to_stderr(stderr)
 
         if stdout:
             roller.stop("finished")
-            time.sleep(1)
+
+
+    def _get_backup_progress(self, fra, written=0):
+        """
+        Get progress of the running RMAN backup as done and total bytes.
+        Between the RMAN steps only bytes, written to the recovery area, are known.
+        """
+        stdout, stderr = self.call_scenario('ora-backup-progress')
+        for done, total in self.get_rows(stdout, long, long):
+            return done, total
+
+        return utils.get_path_size(fra) - written, None
 
 
     def do_backup_hot(self, *args, **params):
@@ -260,19 +283,20 @@ class OracleGate(BaseGate):
             raise GateException("Archivelog is not turned on.\n\tPlease shutdown SUSE Manager and run system-check first!")
 
         print >> sys.stdout, "Backing up the database:\t",
-        roller = Roller()
+        fra = self.get_current_fra_dir()
+        written = utils.get_path_size(fra)
+        roller = Progress(source=lambda: self._get_backup_progress(fra, written), operation='backup-hot',
+                          status=os.path.join(self.get_state_dir(), "progress.state"))
         roller.start()
 
         stdout, stderr = self.call_scenario('rman-hot-backup', target='rman')
 
         if stderr:
             roller.stop("failed")
-            time.sleep(1)
             self.to_stderr(stderr)
 
         if stdout:
             roller.stop("finished")
-            time.sleep(1)
 
             files = []
             arclogs = []
@@ -338,7 +362,7 @@ class OracleGate(BaseGate):
         if len(info):
             print >> sys.stdout, "Last known backup:", info[0].completion
         else:
-            raise GateException("No backups has been found!")
+            raise BackupException("No backups has been found!")
         
         hb, fb, ha, fa = self.check_backup_info()
         # Display backups info
@@ -357,8 +381,7 @@ class OracleGate(BaseGate):
                 print >> sys.stderr, "\tName:", arc.handle
             print >> sys.stderr
             if 'autoresolve' not in args:
-                print >> sys.stderr, "Try using \"autoresolve\" directive."
-                sys.exit(1)
+                raise BackupException("Failed archive logs found. Try using \"autoresolve\" directive.")
             else:
                 self.autoresolve_backup()
                 hb, fb, ha, fa = self.check_backup_info()
@@ -368,8 +391,7 @@ class OracleGate(BaseGate):
                         print >> sys.stderr, "\tName:", arc.handle
                         print >> sys.stderr
                     if 'ignore-errors' not in args:
-                        print >> sys.stderr, "Maybe you want to try \"ignore-errors\" directive and... cross the fingers."
-                        sys.exit(1)
+                        raise BackupException("Maybe you want to try \"ignore-errors\" directive and... cross the fingers.")
                 else:
                     print >> sys.stdout, "Hooray! No failures in backups found!"
         else:
@@ -420,15 +442,12 @@ class OracleGate(BaseGate):
         if dbstatus.ready:
             if 'force' in args:
                 roller.stop("running")
-                time.sleep(1)
                 self.do_db_stop()
             else:
                 roller.stop("failed")
-                time.sleep(1)
                 raise GateException("Database must be put offline. Or use options (run \"help\" for this procedure).")
         else:
             roller.stop("success")
-            time.sleep(1)
         
         print >> sys.stdout, "Restoring from backup:\t",
         roller = Roller()
@@ -438,18 +457,16 @@ class OracleGate(BaseGate):
         
         if stderr:
             roller.stop("failed")
-            time.sleep(1)
             self.to_stderr(stderr)
             
         if stdout:
             roller.stop("finished")
-            time.sleep(1)
 
         self.do_db_stop()
 
         if 'start' in args:
             self.do_db_start()
-            self.do_listener_status()
+            print >> sys.stdout, self.do_listener_status()
 
 
     def do_stats_refresh(self, *args, **params):
@@ -470,7 +487,6 @@ class OracleGate(BaseGate):
         else:
             roller.stop('failed')
 
-        time.sleep(1)
         self.to_stderr(stderr)
             
 
@@ -486,11 +502,12 @@ class OracleGate(BaseGate):
         if ora_error:
             raise GateException("Please visit http://%s.ora-code.com/ page to know more details." % ora_error.lower())
 
-        table = [("Tablespace", "Avail (Mb)", "Used (Mb)", "Size (Mb)", "Use %",),]
-        for name, free, used, size in [" ".join(filter(None, line.replace("\t", " ").split(" "))).split(" ") 
-                                       for line in stdout.strip().split("\n")[2:]]:
-            table.append((name, free, used, size, str(int(float(used) / float(size) * 100)),))
-        print >> sys.stdout, "\n", TablePrint(table), "\n"
+        table = Result([('tablespace', 'Tablespace'), ('available', 'Avail (Mb)', '%.2f'), ('used', 'Used (Mb)', '%.2f'),
+                        ('size', 'Size (Mb)', '%.2f'), ('usage', 'Use %')])
+        for name, free, used, size in self.get_rows(stdout, str, float, float, float):
+            table.append(name, free, used, size, int(used / size * 100))
+
+        return table
 
 
     def do_stats_overview(self, *args, **params):
@@ -506,12 +523,10 @@ class OracleGate(BaseGate):
         stdout, stderr = self.call_scenario('stats', owner=self.config.get('db_user', '').upper())
 
         roller.stop('finished')
-        time.sleep(1)
 
         self.to_stderr(stderr)
 
-        stale = []
-        empty = []
+        result = Result([('relation', 'Relation'), ('status', 'Statistics')])
         if stdout:
             segment = None
             for line in stdout.strip().split("\n"):
@@ -524,33 +539,20 @@ class OracleGate(BaseGate):
 
                 line = line.split(" ")[-1].strip()
 
-                if segment and segment == 'stale':
-                    stale.append(line)
-                elif segment and segment == 'empty':
-                    empty.append(line)
+                if segment:
+                    result.append(line, segment)
                 else:
                     print "Ignoring", repr(line)
 
-        if stale:
-            print >> sys.stdout, "\nList of stale objects:"
-            for obj in stale:
-                print >> sys.stdout, "\t", obj
-            print >> sys.stdout, "\nFound %s stale objects\n" % len(stale)
-        else:
-            print >> sys.stdout, "No stale objects found"
-
-        if empty:
-            print >> sys.stdout, "\nList of empty objects:"
-            for obj in empty:
-                print >> sys.stdout, "\t", obj
-            print >> sys.stdout, "\nFound %s objects that currently have no statistics.\n" % len(stale)
-        else:
-            print >> sys.stdout, "No empty objects found."
+        print >> sys.stdout, "Found %s stale and %s empty objects" % (len([row for row in result.rows if row[1] == 'stale']),
+                                                                     len([row for row in result.rows if row[1] == 'empty']))
 
         if stderr:
             print >> sys.stderr, "Error dump:"
             print >> sys.stderr, stderr
 
+        return result
+
 
     def do_space_reclaim(self, *args, **params):
         """
@@ -567,11 +569,9 @@ class OracleGate(BaseGate):
 
         if stderr:
             roller.stop('failed')
-            time.sleep(1)
             self.to_stderr(stderr)
         else:
             roller.stop('done')
-            time.sleep(1)
 
         print >> sys.stdout, "Gathering recommendations...\t",
 
@@ -583,17 +583,14 @@ class OracleGate(BaseGate):
 
         if not stdout and not stderr:
             roller.stop("finished")
-            time.sleep(1)
             print >> sys.stdout, "\nNo space reclamation possible at this time.\n"
             return
 
         elif stdout:
             roller.stop("done")
-            time.sleep(1)
 
         else:
             roller.stop("failed")
-            time.sleep(1)
             print >> sys.stderr, "Error dump:"
             print >> sys.stderr, stderr
 
@@ -609,12 +606,11 @@ class OracleGate(BaseGate):
         wseg = 0
 
         if stdout:
-            lines = [tuple(filter(None, line.strip().replace("\t", " ").split(" "))) for line in stdout.strip().split("\n")]
-            for ssm, sname, rspace, tsn, stype in lines:
+            for ssm, sname, rspace, tsn, stype in self.get_rows(stdout, str, str, long, str, str):
                 tsns = tree.get(tsn, {})
                 stypes = tsns.get(stype, {})
                 ssms = stypes.get(ssm, [])
-                ssms.append((sname, int(rspace),))
+                ssms.append((sname, rspace,))
                 wseg = len(sname) > wseg and len(sname) or wseg
                 stypes[ssm] = ssms
                 tsns[stype] = stypes
@@ -736,14 +732,7 @@ class OracleGate(BaseGate):
         """
         Show database status.
         """
-        print >> sys.stdout, "Listener:\t",
-        sys.stdout.flush()
-
         dbstatus = self.get_status()
-        print >> sys.stdout, (dbstatus.ready and "running" or "down")
-        print >> sys.stdout, "Uptime:\t\t", dbstatus.uptime and dbstatus.uptime or ""
-        print >> sys.stdout, "Instances:\t", dbstatus.available
-        
         if dbstatus.stderr:
             print >> sys.stderr, "Error dump:"
             print >> sys.stderr, dbstatus.stderr
@@ -753,6 +742,9 @@ class OracleGate(BaseGate):
         if not dbstatus.available:
             print >> sys.stderr, "Critical: No available instances found!"
 
+        return Result([('listener', 'Listener'), ('uptime', 'Uptime'), ('instances', 'Instances')],
+                      [(dbstatus.ready and "running" or "down", dbstatus.uptime or None, dbstatus.available)], record=True)
+
 
     def do_listener_restart(self, *args, **params):
         """
@@ -782,13 +774,11 @@ class OracleGate(BaseGate):
         dbstatus = self.get_status()
         if dbstatus.ready:
             roller.stop('failed')
-            time.sleep(1)
             raise GateException("Error: listener is already running")
         else:
             self.do_listener_start('quiet')
 
         roller.stop('done')
-        time.sleep(1)
 
         print >> sys.stdout, "Starting core...\t",
         sys.stdout.flush()
@@ -797,17 +787,14 @@ class OracleGate(BaseGate):
 
         stdout, stderr = self.syscall("sudo", None, None, "-u", "oracle", self.ora_home + "/bin/dbstart")
         roller.stop('done')
-        time.sleep(1)
 
         self.to_stderr(stderr)
     
         if stdout and stdout.find("Database opened") > -1 \
                 and stdout.find("Database mounted") > -1:
             roller.stop('done')
-            time.sleep(1)
         else:
             roller.stop('failed')
-            time.sleep(1)
             print >> sys.stderr, "Output dump:"
             print >> sys.stderr, stdout
 
@@ -832,10 +819,8 @@ class OracleGate(BaseGate):
         if dbstatus.ready:
             self.do_listener_stop(*['quiet'])
             roller.stop("done")
-            time.sleep(1)
         else:
             roller.stop("not running")
-            time.sleep(1)
 
         print >> sys.stdout, "Stopping core:\t\t",
         sys.stdout.flush()
@@ -845,16 +830,13 @@ class OracleGate(BaseGate):
         dbstatus = self.get_db_status()
         if not dbstatus.ready:
             roller.stop("failed")
-            time.sleep(1)
             raise GateException("Error: database core is already offline.")
 
         stdout, stderr = self.syscall("sudo", None, None, "-u", "oracle", self.ora_home + "/bin/dbshut")
         if stderr:
             roller.stop("failed")
-            time.sleep(1)
         else:
             roller.stop("done")
-            time.sleep(1)
 
         self.to_stderr(stderr)
 
@@ -863,15 +845,7 @@ class OracleGate(BaseGate):
         """
         Display SUSE Manager database runtime status.
         """
-        print >> sys.stdout, "Checking database core...\t",
-        sys.stdout.flush()
-
-        dbstatus = self.get_db_status()
-        if dbstatus.ready:
-            print >> sys.stdout, "online"
-        else:
-            print >> sys.stdout, "offline"
-            
+        return Result([('database', 'Database')], [(self.get_db_status().ready and 'online' or 'offline',)], record=True)
 
 
     def do_space_tables(self, *args, **params):
@@ -880,9 +854,9 @@ class OracleGate(BaseGate):
         """
         dbstatus = self.get_db_status()
         if not dbstatus.ready:
-            raise GateException("Database is not running!")
+            raise NotReadyException("Database is not running!")
 
-        table = [('Table', 'Size',)]
+        table = Result([('table', 'Table'), ('size', 'Size', lambda size: '%.2fK' % round(size / 1024.))])
         total = 0
         stdout, stderr = self.call_scenario('tablesizes', user=self.config.get('db_user', '').upper())
         self.to_stderr(stderr)
@@ -890,19 +864,12 @@ class OracleGate(BaseGate):
         if ora_error:
             raise GateException("Please visit http://%s.ora-code.com/ page to know more details." % ora_error.lower())
 
-        for tname, tsize in filter(None, [filter(None, line.replace("\t", " ").split(" ")) for line in stdout.split("\n")]):
-            table.append((tname, ('%.2fK' % round(float(tsize) / 1024.)),))
+        for tname, tsize in self.get_rows(stdout, str, long):
+            table.append(tname, tsize)
             total += float(tsize)
-        table.append(('', '',))
-        table.append(('Total', ('%.2fM' % round(total / 1024. / 1024.))))
+        table.footer.append(('Total', ('%.2fM' % round(total / 1024. / 1024.))))
 
-        if table:
-            print >> sys.stdout, "\n", TablePrint(table), "\n"
-
-        if stderr:
-            print >> sys.stderr, "Error dump:"
-            print >> sys.stderr, stderr
-            raise Exception("Unhandled underlying error.")
+        return table
 
 
     def do_db_check(self, *args, **params):
@@ -917,7 +884,6 @@ class OracleGate(BaseGate):
                               self.config.get('db_password'),
                               self.config.get('db_name'))
         roller.stop(self.get_db_status(login=login).ready and "ready" or "not available")
-        time.sleep(1)
 
 
     #
@@ -978,6 +944,13 @@ class OracleGate(BaseGate):
         return True
 
 
+    def get_state_dir(self):
+        """
+        Directory of the SMDBA state data.
+        """
+        return os.environ['ORACLE_BASE'] + "/smdba"
+
+
     def do_system_check(self, *args, **params):
         """
         Common backend healthcheck.
@@ -1050,7 +1023,6 @@ class OracleGate(BaseGate):
         else:
             roller.stop(failed)
 
-        time.sleep(1)
 
 
     def get_archivelog_mode(self):
@@ -1155,66 +1127,52 @@ class OracleGate(BaseGate):
         healthy_backups = []
         failed_archivelogs = []
         healthy_archivelogs = []
-        bkpsout = None
-        arlgout = None
-
-        # Get database backups
-        stdout, stderr = self.call_scenario('rman-backup-check-db', target='rman')
-        if stderr:
-            print >> sys.stderr, "Backup information check failure:"
-            print >> sys.stderr, stderr
-            raise GateException("Unable to check the backups.")
 
-        for chunk in stdout.split("RMAN>"):
-            chunk = chunk.strip()
-            if not chunk:
-                continue
-            if chunk.find("crosschecked backup piece") > -1:
-                bkpsout = chunk
-                break
-
-        # Get database archive logs check
-        stdout, stderr = self.call_scenario('rman-backup-check-al', target='rman')
-        if stderr:
-            print >> sys.stderr, "Archive log information check failure:"
-            print >> sys.stderr, stderr
-            raise GateException("Unable to check the archive logs backup.")
-        
-        for chunk in stdout.split("RMAN>"):
-            chunk = chunk.strip()
-            if not chunk:
-                continue
-            if chunk.find("archived log file name") > -1:
-                arlgout = chunk
-                break
+        # Each checked object comes as the status line, followed by its data line.
+        get_data = lambda line: dict(filter(None, map(lambda elm:"=" in elm and tuple(elm.split("=", 1)) or None, filter(None, line.strip().split(" ")))))
 
         # Check failed backups
-        if bkpsout:
-            for line in map(lambda elm:elm.strip(), bkpsout.split("crosschecked")):
-                if not line.startswith("backup piece"):
-                    continue
-                obj_raw = line.split("\n")[:2]
-                if len(obj_raw) == 2:
-                    status = obj_raw[0].strip().split(" ")[-1].replace("'", '').lower()
-                    data = dict(filter(None, map(lambda elm:"=" in elm and tuple(elm.split("=", 1)) or None, filter(None, obj_raw[-1].split(" ")))))
+        status = None
+        errors = []
+        for stream, line in self.call_scenario_lines('rman-backup-check-db', target='rman'):
+            errors += self.extract_line_errors(line)
+            if status is not None:
+                data = get_data(line)
+                if 'handle' in data:
                     hinfo = HandleInfo(status, handle=data['handle'], recid=data['RECID'], stamp=data['STAMP'])
                     if hinfo.availability == 'available':
                         healthy_backups.append(hinfo)
                     else:
-                        failed_backups(hinfo)
+                        failed_backups.append(hinfo)
+                status = None
+            elif line.strip().startswith("crosschecked backup piece"):
+                status = line.strip().split(" ")[-1].replace("'", '').lower()
+
+        if errors:
+            print >> sys.stderr, "Backup information check failure:"
+            print >> sys.stderr, '\n'.join(errors)
+            raise GateException("Unable to check the backups.")
 
         # Check failed archive logs
-        if arlgout:
-            for archline in map(lambda elm:elm.strip(), arlgout.split("validation", 1)[-1].split("Crosschecked")[0].split("validation")):
-                obj_raw = archline.split("\n")
-                if len(obj_raw) == 2:
-                    status = obj_raw[0].split(" ")[0]
-                    data = dict(filter(None, map(lambda elm:'=' in elm and tuple(elm.split('=', 1)) or None, obj_raw[1].split(" "))))
+        status = None
+        for stream, line in self.call_scenario_lines('rman-backup-check-al', target='rman'):
+            errors += self.extract_line_errors(line)
+            if status is not None:
+                data = get_data(line)
+                if 'name' in data:
                     hinfo = HandleInfo(status == 'succeeded' and 'available' or 'unavailable', recid=data['RECID'], stamp=data['STAMP'], handle=data['name']) # Ask RMAN devs why this time it is called "name"
                     if hinfo.availability == 'available':
                         healthy_archivelogs.append(hinfo)
                     else:
                         failed_archivelogs.append(hinfo)
+                status = None
+            elif line.strip().startswith("validation "):
+                status = line.strip().split(" ")[1]
+
+        if errors:
+            print >> sys.stderr, "Archive log information check failure:"
+            print >> sys.stderr, '\n'.join(errors)
+            raise GateException("Unable to check the archive logs backup.")
 
         return healthy_backups, failed_backups, healthy_archivelogs, failed_archivelogs
 
@@ -1259,11 +1217,9 @@ class OracleGate(BaseGate):
         dbstatus = self.get_db_status()
         if dbstatus.ready:
             roller.stop("running")
-            time.sleep(1)
         else:
             roller.stop("failed")
-            time.sleep(1)
-            raise GateException(message);
+            raise NotReadyException(message);
 
 
     def get_current_rfds(self):
@@ -1302,6 +1258,51 @@ class OracleGate(BaseGate):
 
 
 
+    def get_collectors(self):
+        """
+        Metric collectors, from the cheapest and most often refreshed.
+        """
+        return [Collector('database', 15, self._collect_database),
+                Collector('backup', 60, self._collect_backup),
+                Collector('space', 300, self._collect_space),
+                Collector('maintenance', 900, self._collect_maintenance)]
+
+
+    def _collect_database(self):
+        yield 'smdba_database_up', {}, int(self.get_db_status().ready)
+        yield 'smdba_listener_up', {}, int(self.get_status().ready)
+
+
+    def _collect_backup(self):
+        stdout, stderr = self.call_scenario('ora-backup-health')
+        self.to_stderr(stderr)
+        rows = self.get_rows(stdout, long, long, float, long)
+        if not rows:
+            raise GateException("Unable to parse backup health: %s" % stdout.strip())
+        for lag, archived, rate, age in rows:
+            if lag > -1:
+                yield 'smdba_archive_lag_seconds', {}, lag
+            yield 'smdba_archive_bytes', {}, archived
+            yield 'smdba_archive_rate_bytes', {}, round(rate, 1)
+            if age > -1:
+                yield 'smdba_backup_age_seconds', {}, age
+
+
+    def _collect_space(self):
+        fra = self.get_current_fra_dir()
+        if fra and os.path.exists(fra):
+            yield 'smdba_filesystem_free_bytes', {'location': 'backup'}, self.media_usage(fra)['free']
+        for name, free, used, size, usage in self.do_space_overview().rows:
+            yield 'smdba_tablespace_size_bytes', {'tablespace': name}, long(size * 0x100000)
+            yield 'smdba_tablespace_usage_percent', {'tablespace': name}, usage
+
+
+    def _collect_maintenance(self):
+        tables = self.do_stats_overview().rows
+        yield 'smdba_stats_stale_tables', {}, len([name for name, status in tables if status == 'stale'])
+        yield 'smdba_stats_empty_tables', {}, len([name for name, status in tables if status == 'empty'])
+
+
     def startup(self):
         """
         Hooks before the Oracle gate operations starts.
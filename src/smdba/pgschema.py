@@ -0,0 +1,140 @@
+# Schema remapping of the pg_restore SQL output
+#
+#
+# The MIT License (MIT)
+# Copyright (C) 2012 SUSE Linux Products GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Moves objects of the plain SQL stream from pg_restore to another schema.
+Only statements are rewritten, data of the COPY blocks is passed as is.
+
+Usage: pgschema.py SOURCE TARGET < restore.sql | psql
+"""
+
+import re
+import sys
+
+# Start of a quoted identifier, a literal or a comment
+OPENING = re.compile(r'''"(?:[^"]|"")*"|--|/\*|(?<![\w$])[Ee]'|'|(?<![\w$])\$(?:[A-Za-z_]\w*)?\$''')
+
+# Rest of the escape string literal up to its closing quote
+ESCAPED = re.compile(r"(?:\\.|''|[^'\\])*'")
+
+
+def _find_end(line, pos, state):
+    """
+    Find the end of the literal or comment, which is open at the position.
+    Returns the position after it or -1, if it goes on at the next line.
+    """
+    if state == "E'":
+        match = ESCAPED.match(line, pos)
+        return match and match.end() or -1
+    elif state == "'":
+        while True:
+            pos = line.find("'", pos)
+            if pos < 0 or line[pos + 1:pos + 2] != "'":
+                return pos < 0 and -1 or pos + 1
+            pos += 2 # Quote, doubled inside the literal
+
+    pos = line.find(state, pos)
+    return pos < 0 and -1 or pos + len(state)
+
+
+def _requalify(line, state, qualified, names, target):
+    """
+    Qualify the names in the line by the target outside of the string literals,
+    dollar-quoted bodies and comments. Literals, which are names of relations,
+    like the sequences of nextval() and setval(), are qualified as well.
+    State is the closing delimiter of the literal, which is open at the start
+    of the line, or None. Returns the line and the state at its end.
+    """
+    out = []
+    pos = start = 0
+    while pos < len(line):
+        if state:
+            end = _find_end(line, pos, state)
+            if end < 0:
+                out.append(line[pos:])
+                return ''.join(out), state
+            out.append(line[pos:end])
+            pos = start = end
+            state = None
+            continue
+
+        match = OPENING.search(line, pos)
+        if match and match.group().startswith('"'):
+            pos = match.end() # Quoted identifier is a name, not a literal
+            continue
+
+        end = len(line)
+        if match:
+            end = match.start()
+        out.append(qualified.sub(target + ".", line[start:end]))
+        if not match:
+            break
+        if match.group() == "--":
+            out.append(line[end:])
+            break
+
+        name = match.group() == "'" and names.match(line, end)
+        if name:
+            out.append("'" + target + ".")
+            pos = start = name.end()
+            state = "'"
+            continue
+
+        state = {"/*": "*/"}.get(match.group(), match.group()[-1:] == "'" and match.group().upper() or match.group())
+        out.append(match.group())
+        pos = start = match.end()
+
+    return ''.join(out), state
+
+
+def rewrite(source, target, lines):
+    """
+    Yield lines with the names, qualified by the source schema, qualified by the target.
+    """
+    qualified = re.compile(r'(?<![\w"$.])(%s|"%s")\.' % (re.escape(source), re.escape(source)))
+    names = re.compile(r'''(?<=setval\()'(%s|"%s")\.|'(%s|"%s")\.(?=[^']*'::regclass)''' % ((re.escape(source),) * 4))
+    search_path = re.compile(r'^(SET search_path = )(%s|"%s")\b' % (re.escape(source), re.escape(source)))
+    target = '"%s"' % target.replace('"', '""')
+    data = False
+    state = None
+    for line in lines:
+        if data:
+            data = line.rstrip("\r\n") != "\\."
+        else:
+            if not state and line.startswith("COPY ") and line.rstrip().endswith("FROM stdin;"):
+                data = True
+            elif not state:
+                line = search_path.sub(r'\1' + target, line)
+            line, state = _requalify(line, state, qualified, names, target)
+        yield line
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print >> sys.stderr, "Usage: %s SOURCE TARGET" % sys.argv[0]
+        sys.exit(1)
+
+    for line in rewrite(sys.argv[1], sys.argv[2], iter(sys.stdin.readline, '')):
+        sys.stdout.write(line)
@@ -27,30 +27,93 @@
 
 from basegate import BaseGate
 from basegate import GateException
+from basegate import NotReadyException
+from basegate import BackupException
 from roller import Roller
+from roller import Progress
+from roller import wait_for
+from roller import share_output
+from probes import StorageProbe
+from probes import WALSyncProbe
+from exporter import Collector
 from utils import TablePrint
+from utils import Result
 
 import sys
 import os
 import pwd
 import grp
 import time
+import re
+import socket
 import shutil
 import tempfile
+import math
+import multiprocessing
+import json
+import pipes
 import utils
+from threading import Thread
+from subprocess import Popen, PIPE
+
+
+class PgConfig(dict):
+    """
+    Gate configuration, which asks the running server for its settings
+    only when any of them is needed first.
+    """
+
+    def __init__(self, config):
+        dict.__init__(self, config)
+        self.loader = None
+        self.loaded = False
+
+
+    def _load(self, key):
+        if self.loader and not self.loaded and key.startswith('pcnf_') and not dict.__contains__(self, key):
+            self.loaded = True
+            self.loader()
+
+
+    def __getitem__(self, key):
+        self._load(key)
+        return dict.__getitem__(self, key)
+
+
+    def __contains__(self, key):
+        self._load(key)
+        return dict.__contains__(self, key)
+
+
+    def get(self, key, default=None):
+        self._load(key)
+        return dict.get(self, key, default)
+
 
 
 class PgTune(object):
     """
     PostgreSQL tuning.
     """
-    # NOTE: This is default Alpha implementation for SUSE Manager specs.
-    #       With a time it going to get more smart and dynamic.
+    # NOTE: Memory ratios are the SUSE Manager baseline. They are corrected
+    #       by the live workload statistics of the server, when available.
 
 
-    def __init__(self):
+    def __init__(self, version=0, workload=None, storage=None, wal=None):
+        """
+        Version is a server version number, like 90603.
+        Workload is a dictionary of the live statistics of the server.
+        Storage is a dictionary of the data directory storage probe results.
+        WAL is a dictionary of the operations per second of each sync method.
+        """
+        self.version = version or 90100
+        self.workload = workload or {}
+        self.storage = storage or {}
+        self.wal = wal or {}
         self.max_connections = 80
         self.config = {}
+        self.reasons = {}
+        self.obsolete = []
 
 
     def get_total_memory(self):
@@ -63,6 +126,16 @@ class PgTune(object):
             return None
 
 
+    def get_cpu_count(self):
+        """
+        Get machine CPU count.
+        """
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+
     def br(self, value):
         """
         Binary rounding.
@@ -80,35 +153,153 @@ class PgTune(object):
         return str(value / 0x400) + 'MB'
 
 
+    def get_storage_class(self):
+        """
+        Classify the storage from the probe results: nvme, ssd, san, hdd.
+        Returns None if the storage was not probed.
+        """
+        if not self.storage:
+            return None
+
+        iops = int(self.storage.get('random_iops', 0))
+        if self.storage.get('rotational') == 'True' or (iops and iops < 500):
+            return 'hdd'
+        elif self.storage.get('direct') != 'True':
+            return None # Page cache was measured
+        elif iops >= 20000:
+            return 'nvme'
+        elif iops >= 2000:
+            return 'ssd'
+
+        return 'san'
+
+
+    def set(self, name, value, reason):
+        """
+        Set recommended value with the explanation.
+        """
+        self.config[name] = value
+        self.reasons[name] = reason
+
+
     def estimate(self):
         """
         Estimate the data.
         """
         KB = 0x400
-        MB = KB * 0x400
-        GB = MB * 0x400
+        GB = KB * KB # In kilobytes
 
         mem = self.get_total_memory()
         if not mem:
             raise Exception("Cannot get total memory of this system")
 
         mem = mem / KB
-        if mem > 0xff * MB:
+        if mem < 0xff * KB:
             raise Exception("This is a low memory system and is not supported!")
 
-        self.config['shared_buffers'] = self.toMB(self.br(mem / 4))
-        self.config['effective_cache_size'] = self.toMB(self.br(mem * 3 / 4))
-        self.config['work_mem'] = self.toMB(self.br(mem / self.max_connections))
+        cpus = self.get_cpu_count()
+        workload = self.workload
+
+        # Connections. Peak is only seen so far, so it never lowers the baseline.
+        peak = workload.get('peak_connections')
+        if peak and int(math.ceil(peak * 1.5 / 10.)) * 10 > self.max_connections:
+            self.max_connections = int(math.ceil(peak * 1.5 / 10.)) * 10
+            self.set('max_connections', self.max_connections,
+                     "Peak of %s connections observed, plus 50%% headroom" % peak)
+        elif peak:
+            self.set('max_connections', self.max_connections,
+                     "SUSE Manager default, peak of %s connections observed fits into it" % peak)
+        else:
+            self.set('max_connections', self.max_connections, "SUSE Manager default, no connections observed yet")
+
+        # Memory
+        hit_ratio = workload.get('cache_hit_ratio')
+        if hit_ratio is not None and hit_ratio < 0.9:
+            shared_buffers = self.br(mem / 3)
+            self.set('shared_buffers', self.toMB(shared_buffers),
+                     "Cache hit ratio is only %.1f%%, a third of RAM" % (hit_ratio * 100))
+        else:
+            shared_buffers = self.br(mem / 4)
+            self.set('shared_buffers', self.toMB(shared_buffers), "A quarter of RAM" +
+                     (hit_ratio is not None and ", cache hit ratio is %.1f%%" % (hit_ratio * 100) or ""))
+
+        self.set('effective_cache_size', self.toMB(self.br(mem * 3 / 4)),
+                 "Three quarters of RAM are expected to cache data")
+
+        work_mem = self.br(max((mem - shared_buffers) / (self.max_connections * 3), KB))
+        temp_files, temp_bytes = workload.get('temp_files'), workload.get('temp_bytes')
+        if temp_files and temp_bytes / temp_files / KB > work_mem:
+            # Sorts and hashes spilled to disk: make them fit, but never
+            # allow all connections together to take more than free RAM.
+            work_mem = self.br(min(temp_bytes / temp_files / KB, (mem - shared_buffers) / self.max_connections))
+            self.set('work_mem', self.toMB(work_mem), "%s temporary files of %s average size were written"
+                     % (temp_files, self.toMB(temp_bytes / temp_files / KB)))
+        else:
+            self.set('work_mem', self.toMB(work_mem), "RAM left from shared buffers, spread over connections")
+
+        self.set('maintenance_work_mem', self.toMB(self.br(min(mem / 0x10, GB))), "1/16 of RAM, but no more than 1GB")
+
+        # Checkpoints
+        timed, requested = workload.get('checkpoints_timed'), workload.get('checkpoints_req')
+        forced = (timed is not None and requested is not None and timed + requested) \
+            and float(requested) / (timed + requested) or 0
+        if forced > 0.1:
+            reason = "%.f%% of checkpoints were forced by WAL volume" % (forced * 100)
+        else:
+            reason = "Checkpoints are mostly on time"
+
+        if self.version >= 90500:
+            self.obsolete.append('checkpoint_segments')
+            self.set('min_wal_size', '256MB', "Keep recycled WAL segments for the load peaks")
+            self.set('max_wal_size', forced > 0.1 and '4GB' or '1GB', reason)
+        else:
+            self.set('checkpoint_segments', forced > 0.1 and 32 or 8, reason)
+
+        # Storage
+        storage = self.get_storage_class()
+        if storage:
+            random_page_cost, io_concurrency, completion_target = {
+                'nvme': ('1.1', 256, '0.7'),
+                'ssd': ('1.1', 200, '0.7'),
+                'san': ('2.0', 32, '0.9'),
+                'hdd': ('4.0', 2, '0.9'),
+                }[storage]
+            reason = "Storage is %s class, %s random reads per second" % (storage.upper(), self.storage.get('random_iops'))
+            self.set('random_page_cost', random_page_cost, reason)
+            self.set('effective_io_concurrency', io_concurrency, reason)
+            self.set('checkpoint_completion_target', completion_target,
+                     completion_target == '0.7' and "Fast storage flushes checkpoints quickly"
+                     or "Slow storage, spread checkpoint writes over the interval")
+        else:
+            self.set('checkpoint_completion_target', '0.7', "Spread checkpoint writes over the interval")
+        # WAL
+        if self.wal:
+            rates = sorted([(int(ops), method) for method, ops in self.wal.items()], reverse=True)
+            commits, method = rates[0]
+            flush = 1000000 / max(commits, 1) # Microseconds per WAL flush
+
+            self.set('wal_sync_method', method, "Fastest sync method, %s commits per second" % commits)
+            self.set('synchronous_commit', 'on', "SUSE Manager data must survive a crash")
+            if flush > 2000:
+                # Slow flushes: let concurrent commits join the same flush.
+                self.set('wal_buffers', '64MB', "WAL flush takes %.1fms, buffer more WAL between flushes" % (flush / 1000.))
+                self.set('commit_delay', min(flush / 2, 1000), "Half of the WAL flush time to group commits")
+                self.set('commit_siblings', 5, "Group commits only under concurrent load")
+            else:
+                self.set('wal_buffers', '16MB', "One WAL segment")
+                self.set('commit_delay', 0, "WAL flush takes only %.1fms, no commit grouping needed" % (flush / 1000.))
+        else:
+            self.set('wal_buffers', '16MB', "One WAL segment")
 
-        # No more than 1GB
-        self.config['maintenance_work_mem'] = self.toMB(self.br((mem / 0x10) > MB and MB or mem / 0x10))
+        # Parallel query
+        if self.version >= 90600:
+            self.set('max_worker_processes', max(8, cpus), "%s CPUs available" % cpus)
+            self.set('max_parallel_workers_per_gather', max(1, min(4, cpus / 2)), "Half of %s CPUs, up to 4" % cpus)
+        if self.version >= 100000:
+            self.set('max_parallel_workers', cpus, "%s CPUs available" % cpus)
 
-        self.config['checkpoint_segments'] = 8
-        self.config['checkpoint_completion_target'] = '0.7'
-        self.config['wal_buffers'] = self.toMB(0x200 * self.config['checkpoint_segments'])
-        self.config['constraint_exclusion'] = 'off'
-        self.config['default_statistics_target'] = 10
-        self.config['max_connections'] = self.max_connections
+        self.set('constraint_exclusion', 'off', "SUSE Manager does not use partitioning")
+        self.set('default_statistics_target', 10, "SUSE Manager default")
 
         return self
 
@@ -120,13 +311,47 @@ class PgSQLGate(BaseGate):
     """
     NAME = "postgresql"
 
+    # Table statistics are stale when modified rows exceed the
+    # threshold plus this fraction of the table rows.
+    STATS_THRESHOLD = 50
+    STATS_SCALE = 0.1
+
+    # Target time in seconds between two autovacuum runs on a hot table.
+    AUTOVACUUM_PERIOD = 900
+
+    # Seconds to wait for the database to start or to stop.
+    DB_START_TIMEOUT = 300
+    DB_STOP_TIMEOUT = 300
+
+    # Buffer cache warm-up after the database start.
+    PREWARM_SNAPSHOT = "prewarm.snapshot"
+    PREWARM_FRACTION = 0.5
+    PREWARM_JOBS = 4
+
+    # Logical dumps: CPU (nice) and I/O (ionice) scheduling of the dump by its priority,
+    # and seconds to wait for a table lock, before the dump fails instead of queueing
+    # the other sessions behind it.
+    DUMP_PRIORITY = {
+        'normal': ([], []),
+        'low': (['-n', '10'], ['-c', '2', '-n', '7']),
+        'idle': (['-n', '19'], ['-c', '3']),
+    }
+    DUMP_LOCK_TIMEOUT = 60
+
+    # Entries of the dump, which belong to the tables. Longer names go first, as the names are matched by their start.
+    DUMP_TYPES = ['SEQUENCE OWNED BY', 'SEQUENCE SET', 'TABLE DATA', 'FK CONSTRAINT', 'CONSTRAINT',
+                  'INDEX', 'SEQUENCE', 'DEFAULT', 'TRIGGER', 'TABLE']
+
+    # Settings of the restore sessions: commits are not waiting for the disk
+    # and the indexes are built in bulk with more memory.
+    RESTORE_OPTIONS = "-c synchronous_commit=off -c maintenance_work_mem=512MB"
+
 
     def __init__(self, config):
-        self.config = config or {}
+        self.config = PgConfig(config or {})
         self._get_sysconfig()
         self._get_pg_data()
-        if self._get_db_status():
-            self._get_pg_config()
+        self.config.loader = lambda: self._get_db_status() and self._get_pg_config()
 
 
     # Utils
@@ -135,7 +360,7 @@ class PgSQLGate(BaseGate):
         Check system requirements for this gate.
         """
         msg = None
-        if os.popen('/usr/bin/postmaster --version').read().strip().split(' ')[-1] < '9.1':
+        if self._get_server_version() < 90100:
             raise GateException("Core component is too old version.")
         elif not os.path.exists("/etc/sysconfig/postgresql"):
             raise GateException("Custom core component? Please strictly use SUSE components only!")
@@ -154,6 +379,70 @@ class PgSQLGate(BaseGate):
         return True
 
 
+    def get_state_dir(self):
+        """
+        Directory of the SMDBA state data, next to the data directory.
+        Each cluster has its own, as data directories may be siblings.
+        """
+        path = os.path.dirname(os.path.normpath(self.config['pcnf_pg_data'])) + "/smdba"
+        if self.config.get('cluster_name'):
+            path += "/" + self.config['cluster_name']
+
+        return path
+
+
+    def _get_server_version(self):
+        """
+        Get server version number, like 90603 for 9.6.3 or 100004 for 10.4.
+        """
+        if self.config.loaded and self.config.get('pcnf_server_version_num'):
+            return int(self.config['pcnf_server_version_num'])
+
+        def check():
+            version = map(int, re.findall(r'\d+', self.shell_output('/usr/bin/postmaster --version').strip().split(' ')[-1]))
+            major, minor, patch = (version + [0, 0, 0])[:3]
+
+            # Since 10 the version has only two components
+            return major >= 10 and major * 10000 + minor or major * 10000 + minor * 100 + patch
+
+        return int(self.get_checked('postmaster-version', ['/usr/bin/postmaster'], check))
+
+
+    def _get_workload(self):
+        """
+        Get live workload statistics of the running server.
+        Peak of the connections is kept across the runs.
+        """
+        workload = {}
+        if not self._get_db_status():
+            return workload
+
+        stdout, stderr = self.call_scenario('pg-workload', target='psql')
+        for name, value in self.get_rows(stdout, str, long):
+            workload[name] = value
+
+        if workload.get('blks_hit', 0) + workload.get('blks_read', 0):
+            workload['cache_hit_ratio'] = float(workload['blks_hit']) / (workload['blks_hit'] + workload['blks_read'])
+
+        state = self.load_state('workload')
+        workload['peak_connections'] = max(workload.get('connections', 0), int(state.get('peak_connections', 0)))
+        if workload['peak_connections']:
+            state['peak_connections'] = workload['peak_connections']
+            self.save_state('workload', **state)
+
+        return workload
+
+
+    def get_config_files(self):
+        """
+        Files, which the gate configuration is read from.
+        Postmaster PID file tells that the database was started or stopped meanwhile.
+        """
+        return ["/etc/sysconfig/postgresql",
+                self.config['pcnf_pg_data'] + "/postgresql.conf",
+                self.config['pcnf_pg_data'] + "/postmaster.pid"]
+
+
     def _get_sysconfig(self):
         """
         Read the system config for the postgresql.
@@ -181,10 +470,44 @@ class PgSQLGate(BaseGate):
         return status
 
 
+    def _get_db_ready(self):
+        """
+        Return True if the running database accepts connections on its socket.
+        """
+        if not self._get_db_status():
+            return False
+
+        # Lines of postmaster.pid: pid, data directory, start time, port,
+        # socket directory, listen address, shared memory key and status (since 10).
+        try:
+            info = [line.strip() for line in open(self.config.get('pcnf_pg_data', '') + '/postmaster.pid').readlines()]
+        except IOError:
+            return False
+        if len(info) < 5 or (len(info) > 7 and info[7] not in ['ready', 'standby']):
+            return False
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(os.path.join(info[4] or '/tmp', '.s.PGSQL.' + info[3]))
+                return True
+            except socket.error:
+                return False
+        finally:
+            sock.close()
+
+
     def _get_pg_data(self):
         """
-        PostgreSQL data dir from sysconfig.
+        PostgreSQL data dir from sysconfig, unless the gate is made for one of the clusters.
         """
+        if self.config.get('cluster_data'):
+            self.config['pcnf_pg_data'] = os.path.expanduser(self.config['cluster_data'])
+            if not os.path.exists(self.config['pcnf_pg_data']):
+                raise GateException('Cannot find data directory of the cluster "%s": %s'
+                                    % (self.config['cluster_name'], self.config['pcnf_pg_data']))
+            return
+
         for line in open("/etc/sysconfig/postgresql").readlines():
             if line.startswith('POSTGRES_DATADIR'):
                 self.config['pcnf_pg_data'] = os.path.expanduser(line.strip().split('=', 1)[-1].replace('"', ''))
@@ -205,12 +528,8 @@ class PgSQLGate(BaseGate):
                                       .replace('@scenario', 'show all'),
                                       None, "-u", "postgres", "/bin/bash")
         if stdout:
-            for line in stdout.strip().split("\n")[2:]:
-                try:
-                    k, v = map(lambda line:line.strip(), line.split('|')[:2])
-                    self.config['pcnf_' + k] = v
-                except:
-                    print >> sys.stdout, "Cannot parse line:", line
+            for name, setting, description in self.get_rows(stdout, str, str, str):
+                self.config['pcnf_' + name] = setting
         else:
             print >> sys.stderr, stderr
             raise Exception("Underlying error: unable get backend configuration.")
@@ -223,12 +542,31 @@ class PgSQLGate(BaseGate):
         return int(round(v / 1024. / 1024.))
 
 
+    def _get_port(self):
+        """
+        Port of the cluster. Settings of the server are used, when they are
+        already known, as the server is not running before its start.
+        """
+        if self.config.get('cluster_port'):
+            return self.config['cluster_port']
+        if self.config.loaded and self.config.get('pcnf_port'):
+            return self.config['pcnf_port']
+        try:
+            port = self._get_conf(self.config['pcnf_pg_data'] + "/postgresql.conf").get('port', '')
+        except GateException:
+            port = ''
+
+        return port.strip("'\"") or '5432'
+
+
     def _cleanup_pids(self):
         """
         Cleanup PostgreSQL garbage in /tmp
         """
-        for f in os.listdir('/tmp'):
-            if f.startswith('.s.PGSQL.'):
+        # Sockets of the other clusters on the host are in use
+        name = '.s.PGSQL.' + self._get_port()
+        for f in [name, name + '.lock']:
+            if os.path.lexists('/tmp/' + f):
                 os.unlink('/tmp/' + f)
 
 
@@ -247,7 +585,7 @@ class PgSQLGate(BaseGate):
             try:
                 k, v = [el.strip() for el in line.split('#')[0].strip().split('=', 1)]
                 conf[k] = v
-            except Exception, ex:
+            except Exception:
                 raise GateException("Cannot parse line [%s] in %s." % (line, conf_path))
 
         return conf
@@ -282,6 +620,8 @@ class PgSQLGate(BaseGate):
     def do_db_start(self, **args):
         """
         Start the SUSE Manager Database.
+        @help
+        --prewarm=<value>\tFraction of shared buffers to warm up from the snapshot, taken at stop. Default: 0.5
         """
         print >> sys.stdout, "Starting core...\t",
         sys.stdout.flush()
@@ -291,24 +631,22 @@ class PgSQLGate(BaseGate):
         if self._get_db_status():
             print >> sys.stdout, "failed"
             #roller.stop('failed')
-            time.sleep(1)
             return
 
         # Cleanup first
         self._cleanup_pids()
 
         # Start the db
-        cwd = os.getcwd()
-        os.chdir(self.config.get('pcnf_data_directory', '/var/lib/pgsql'))
-        if not os.system("sudo -u postgres /usr/bin/pg_ctl start -s -w -p /usr/bin/postmaster -D %s -o %s"
-                         % (self.config['pcnf_pg_data'], self.config.get('sysconfig_POSTGRES_OPTIONS', '""'))):
+        if not self.shell_call("sudo -u postgres /usr/bin/pg_ctl start -s -W -p /usr/bin/postmaster -D %s -o %s"
+                         % (self.config['pcnf_pg_data'], self.config.get('sysconfig_POSTGRES_OPTIONS', '""')),
+                         cwd=self.config.get('pcnf_data_directory', '/var/lib/pgsql')) \
+                         and wait_for(self._get_db_ready, timeout=self.DB_START_TIMEOUT):
             print >> sys.stdout,  "done"
+            self._prewarm(args.get('prewarm', self.config.get('db_prewarm_fraction', self.PREWARM_FRACTION)))
         else:
             print >> sys.stderr, "failed"
-        os.chdir(cwd)
 
         #roller.stop('done')
-        time.sleep(1)
 
 
     def do_db_stop(self, **args):
@@ -321,29 +659,112 @@ class PgSQLGate(BaseGate):
         if not self._get_db_status():
             print >> sys.stdout, "failed"
             #roller.stop('failed')
-            time.sleep(1)
             return
 
         # Stop the db
         if not self.config.get('pcnf_data_directory'):
             raise GateException("Cannot find data directory.")
-        cwd = os.getcwd()
-	os.chdir(self.config.get('pcnf_data_directory', '/var/lib/pgsql'))
-        if not os.system("sudo -u postgres /usr/bin/pg_ctl stop -s -D %s -m fast" % self.config.get('pcnf_data_directory', '')):
+        self._prewarm_snapshot()
+        if not self.shell_call("sudo -u postgres /usr/bin/pg_ctl stop -s -W -D %s -m fast" % self.config.get('pcnf_data_directory', ''),
+                               cwd=self.config.get('pcnf_data_directory', '/var/lib/pgsql')) \
+                and wait_for(lambda: not self._get_db_status(), timeout=self.DB_STOP_TIMEOUT):
             print >> sys.stdout, "done"
         else:
             print >> sys.stderr, "failed"
-        os.chdir(cwd)
 
         # Cleanup
         self._cleanup_pids()
 
 
+    def _has_extension(self, name):
+        """
+        Check if the extension is installed in the database.
+        """
+        stdout, stderr = self.syscall("sudo", self.get_scenario_template(target='psql').replace(
+                '@scenario', "SELECT count(*) FROM pg_extension WHERE extname = '%s';" % name),
+                                      None, "-u", "postgres", "/bin/bash")
+        return self.get_rows(stdout, int) == [(1,)]
+
+
+    def _prewarm_snapshot(self):
+        """
+        Save hot block ranges of the relations, before the database goes down.
+        Buffer cache inspection is used if available, block hit statistics otherwise.
+        """
+        scenario = self._has_extension('pg_buffercache') and 'pg-hot-blocks' or 'pg-hot-relations'
+        stdout, stderr = self.call_scenario(scenario, target='psql')
+
+        ranges = [self.FIELD_SEPARATOR.join(map(str, row)) for row in self.get_rows(stdout, str, int, int)]
+
+        if ranges:
+            if not os.path.exists(self.get_state_dir()):
+                os.makedirs(self.get_state_dir(), 0700)
+            snapshot = open(os.path.join(self.get_state_dir(), self.PREWARM_SNAPSHOT), 'w')
+            snapshot.write('\n'.join(ranges) + '\n')
+            snapshot.close()
+
+
+    def _prewarm(self, fraction):
+        """
+        Warm up the buffer cache from the snapshot in the background.
+        Ranges are loaded hottest first, until the fraction of shared buffers is taken.
+        """
+        snapshot = os.path.join(self.get_state_dir(), self.PREWARM_SNAPSHOT)
+        if not os.path.exists(snapshot):
+            return
+
+        try:
+            fraction = float(fraction)
+        except ValueError:
+            raise GateException("Prewarm fraction should be a number between 0 and 1.")
+
+        ranges = []
+        for line in open(snapshot).readlines():
+            line = line.rstrip("\n").split(self.FIELD_SEPARATOR)
+            if len(line) == 3:
+                ranges.append((line[0], int(line[1]), int(line[2]),))
+        os.unlink(snapshot) # Snapshot is valid only for one start
+        if not ranges or fraction <= 0:
+            return
+
+        stdout, stderr = self.syscall("sudo", self.get_scenario_template(target='psql').replace(
+                '@scenario', "SELECT setting FROM pg_settings WHERE name = 'shared_buffers';\n"
+                "CREATE EXTENSION IF NOT EXISTS pg_prewarm;"), None, "-u", "postgres", "/bin/bash")
+        if stdout.find('ERROR:') > -1 or not stdout.split("\n")[0].strip().isdigit():
+            print >> sys.stderr, "WARNING: Buffer cache warm-up is not available, pg_prewarm extension is missing."
+            return
+
+        budget = int(stdout.split("\n")[0].strip()) * min(fraction, 1.0)
+        sessions = [[0, []] for idx in range(self.PREWARM_JOBS)]
+        for relation, first, last in ranges:
+            if budget <= 0:
+                break
+            last = min(last, first + int(budget) - 1)
+            budget -= last - first + 1
+            session = min(sessions, key=lambda session:session[0])
+            session[0] += last - first + 1
+            session[1].append("SELECT pg_prewarm('%s', 'buffer', 'main', %s, %s);"
+                              % (relation.replace("'", "''"), first, last))
+
+        print >> sys.stdout, "Warming up %s blocks in the background." % sum([used for used, statements in sessions])
+        null = open(os.devnull, 'w')
+        for size, statements in sessions:
+            if not statements:
+                continue
+            # Detached from this process, so the warm-up continues after smdba has finished.
+            warmer = Popen(["sudo", "-u", "postgres", "/bin/bash"], stdin=PIPE, stdout=null, stderr=null,
+                           preexec_fn=os.setsid, env=os.environ)
+            warmer.stdin.write(self.get_scenario_template(target='psql').replace(
+                    '@scenario', '\n'.join(statements).replace('$', '\$')))
+            warmer.stdin.close()
+        null.close()
+
+
     def do_db_status(self, **args):
         """
         Show database status.
         """
-        print 'Database is', self._get_db_status() and 'online' or 'offline'
+        return Result([('database', 'Database')], [(self._get_db_status() and 'online' or 'offline',)], record=True)
 
 
     def do_space_tables(self, **args):
@@ -352,40 +773,23 @@ class PgSQLGate(BaseGate):
         """
         stdout, stderr = self.call_scenario('pg-tablesizes', target='psql')
 
-        if stderr:
-            print >> sys.stderr, stderr
-            raise GateException("Unhandled underlying error occurred, see above.")
+        self.to_stderr(stderr)
 
-        if stdout:
-            t_index = []
-            t_ref = {}
-            t_total = 0
-            longest = 0
-            for line in stdout.strip().split("\n")[2:]:
-                line = filter(None, map(lambda el:el.strip(), line.split('|')))
-                if len(line) == 3:
-                    t_name, t_size_pretty, t_size = line[0], line[1], int(line[2])
-                    t_ref[t_name] = t_size_pretty
-                    t_total += t_size
-                    t_index.append(t_name)
-
-                    longest = len(t_name) > longest and len(t_name) or longest
-
-            t_index.sort()
-
-            table = [('Table', 'Size',)]
-            for name in t_index:
-                table.append((name, t_ref[name],))
-            table.append(('', '',))
-            table.append(('Total', ('%.2f' % round(t_total / 1024. / 1024)) + 'M',))
-            print >> sys.stdout, "\n", TablePrint(table), "\n"
+        result = Result([('table', 'Table'), ('size_pretty', 'Size'), ('size', 'Bytes')])
+        t_total = 0
+        for t_name, t_size_pretty, t_size in sorted(self.get_rows(stdout, str, str, long)):
+            result.append(t_name, t_size_pretty, t_size)
+            t_total += t_size
+        result.footer.append(('Total', ('%.2f' % round(t_total / 1024. / 1024)) + 'M', t_total,))
+
+        return result
 
 
     def _get_partition(self, fdir):
         """
         Get partition of the directory.
         """
-        return os.popen("df -lP %s | tail -1 | cut -d' ' -f 1" % fdir).read().strip()
+        return self.shell_output("df -lP %s | tail -1 | cut -d' ' -f 1" % fdir).strip()
 
 
     def do_space_overview(self, **args):
@@ -396,7 +800,7 @@ class PgSQLGate(BaseGate):
         # and reports free space.
 
         if not self._get_db_status():
-            raise GateException("Database must be running.")
+            raise NotReadyException("Database must be running.")
 
         # Get current partition
         partition = self._get_partition(self.config['pcnf_data_directory'])
@@ -411,7 +815,7 @@ class PgSQLGate(BaseGate):
             mountpoint = None
 
         info = Info()
-        for line in os.popen("df -T").readlines()[1:]:
+        for line in self.shell_output("df -T").split("\n")[1:]:
             line = line.strip()
             if not line.startswith(partition):
                 continue
@@ -431,19 +835,14 @@ class PgSQLGate(BaseGate):
                                                                                                 'select pg_database_size(datname), datname from pg_database;'),
                                       None, "-u", "postgres", "/bin/bash")
         self.to_stderr(stderr)
-        overview = [('Tablespace', 'Size (Mb)', 'Avail (Mb)', 'Use %',)]
-        for line in stdout.split("\n")[2:]:
-            line = filter(None, line.strip().replace('|', '').split(" "))
-            if len(line) != 2:
-                continue
-            d_size = int(line[0])
-            d_name = line[1]
+        overview = Result([('tablespace', 'Tablespace'), ('size', 'Size (Mb)', self._bt_to_mb),
+                           ('available', 'Avail (Mb)', self._bt_to_mb), ('usage', 'Use %', '%.3f')])
+        for d_size, d_name in self.get_rows(stdout, long, str):
             d_size_available = (info.available - d_size)
-            overview.append((d_name, self._bt_to_mb(d_size),
-                             self._bt_to_mb(d_size_available),
-                             '%.3f' % round((float(d_size) / float(d_size_available) * 100), 3)))
+            overview.append(d_name, d_size, d_size_available,
+                            round((float(d_size) / float(d_size_available) * 100), 3))
 
-        print >> sys.stdout, "\n", TablePrint(overview), "\n"
+        return overview
 
 
     def do_space_reclaim(self, **args):
@@ -457,14 +856,11 @@ class PgSQLGate(BaseGate):
         #roller.start()
 
         if not self._get_db_status():
-            roller.stop('failed')
-            time.sleep(1)
-            #print >> sys.stderr, "failed"
-            raise GateException("Database must be online.")
+            print >> sys.stdout, "failed"
+            raise NotReadyException("Database must be online.")
 
         print >> sys.stderr, "finished"
         #roller.stop('done')
-        time.sleep(1)
 
         operations = [
             ('Analyzing database', 'vacuum analyze;'),
@@ -478,27 +874,258 @@ class PgSQLGate(BaseGate):
             #roller.start()
 
             stdout, stderr = self.syscall("sudo", self.get_scenario_template(target='psql').replace('@scenario', operation),
-                                          None, "-u", "postgres", "/bin/bash")
+                                          None, "-u", "postgres", "/bin/bash", timeout=0)
             if stderr:
                 #roller.stop('failed')
-                #time.sleep(1)
                 print >> sys.stderr, "failed"
                 sys.stdout.flush()
-                print >> sys.stderr, stderr
-                raise GateException("Unhandled underlying error occurred, see above.")
+                self.to_stderr(stderr)
 
             else:
                 #roller.stop('done')
-                #time.sleep(1)
                 print >> sys.stdout, "done"
                 sys.stdout.flush()
                 #print stdout
 
+
+    def _get_stats_status(self):
+        """
+        Get statistics status of all user tables, biggest first.
+        Returns a list of (relation, size, status) tuples, where status is
+        one of "fresh", "stale" or "empty".
+        """
+        # n_mod_since_analyze is available only since 9.4. Before that the drift
+        # of live tuples against the last analyzed estimate is the best guess.
+        if int(self.config.get('pcnf_server_version_num', 0) or 0) >= 90400:
+            modified = 'S.n_mod_since_analyze'
+        else:
+            modified = 'abs(S.n_live_tup - C.reltuples)'
+
+        stdout, stderr = self.call_scenario('pg-stats', target='psql', modified=modified,
+                                            threshold=str(self.STATS_THRESHOLD), scale=str(self.STATS_SCALE))
+        self.to_stderr(stderr)
+
+        return self.get_rows(stdout, str, long, str)
+
+
+    def _analyze_tables(self, tables, jobs):
+        """
+        Run ANALYZE on the given (relation, size) tables in concurrent sessions.
+        Biggest tables go first to the least loaded session, so all sessions
+        are finishing at about the same time. Returns list of errors.
+        """
+        sessions = [[0, []] for idx in range(max(1, min(jobs, len(tables))))]
+        for name, size in sorted(tables, key=lambda table:table[1], reverse=True):
+            session = min(sessions, key=lambda session:session[0])
+            session[0] += size
+            session[1].append(name)
+
+        errors = []
+        def analyze(names):
+            scenario = '\n'.join(["ANALYZE %s;" % name for name in names]).replace('$', '\$')
+            stdout, stderr = self.syscall("sudo", self.get_scenario_template(target='psql').replace('@scenario', scenario),
+                                          None, "-u", "postgres", "/bin/bash", timeout=0)
+            errors.extend([line.strip() for line in (stdout + "\n" + stderr).split("\n") if line.find('ERROR:') > -1])
+
+        workers = [Thread(target=analyze, args=(names,)) for size, names in sessions if names]
+        for worker in workers:
+            share_output(worker)
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        return errors
+
+
+    def do_stats_overview(self, *args, **params):
+        """
+        Show tables with stale or empty statistics.
+        """
+        if not self._get_db_status():
+            raise NotReadyException("Database must be running.")
+
+        print >> sys.stdout, "Preparing data:\t\t",
+        sys.stdout.flush()
+        roller = Roller()
+        roller.start()
+
+        tables = self._get_stats_status()
+
+        roller.stop('finished')
+
+        result = Result([('relation', 'Relation'), ('size', 'Size'), ('status', 'Statistics')],
+                        [row for row in tables if row[2] != 'fresh'])
+        print >> sys.stdout, "Found %s stale and %s empty objects" % (len([row for row in result.rows if row[2] == 'stale']),
+                                                                     len([row for row in result.rows if row[2] == 'empty']))
+
+        return result
+
+
+    def do_stats_refresh(self, *args, **params):
+        """
+        Gather statistics on SUSE Manager database objects.
+        @help
+        all\t\t\tAnalyze all tables, not only stale or empty ones.
+        --jobs=<value>\tNumber of concurrent sessions. Default: number of CPUs, up to 4.
+        """
+        if not self._get_db_status():
+            raise NotReadyException("Database must be running.")
+
+        try:
+            jobs = int(params.get('jobs', min(4, multiprocessing.cpu_count())))
+        except ValueError:
+            raise GateException("Number of jobs should be an integer.")
+
+        print >> sys.stdout, "Examining statistics...\t\t",
+        sys.stdout.flush()
+        roller = Roller()
+        roller.start()
+
+        tables = [(name, size) for name, size, status in self._get_stats_status() if 'all' in args or status != 'fresh']
+
+        roller.stop('%s table%s to analyze' % (len(tables), len(tables) != 1 and 's' or ''))
+
+        if not tables:
+            return
+
+        print >> sys.stdout, "Gathering statistics on SUSE Manager database...\t",
+        sys.stdout.flush()
+        roller = Roller()
+        roller.start()
+
+        errors = self._analyze_tables(tables, jobs)
+
+        roller.stop(errors and 'failed' or 'finished')
+
+        if errors:
+            print >> sys.stderr, "Error dump:"
+            print >> sys.stderr, '\n'.join(errors)
+
+
+    def _get_table_churn(self):
+        """
+        Sample cumulative row activity counters of all user tables.
+        """
+        stdout, stderr = self.call_scenario('pg-table-churn', target='psql')
+        self.to_stderr(stderr)
+
+        sample = {}
+        for name, ins, upd, hot_upd, dlt, live, dead, options in self.get_rows(stdout, str, long, long, long, long, long, long, str):
+            options = options != '-' and options or ''
+            sample[name] = {'ins': ins, 'upd': upd, 'hot_upd': hot_upd, 'del': dlt,
+                            'live': live, 'dead': dead, 'options': options}
+
+        return sample
+
+
+    def _autovacuum_advise(self, first, second, interval):
+        """
+        Propose autovacuum storage parameters from two activity samples.
+        Returns a list of (relation, rates, parameters) for the tables
+        that churn faster than the default settings can keep up with.
+        """
+        advice = []
+        for name in sorted(second.keys()):
+            if name not in first:
+                continue
+            prev, curr = first[name], second[name]
+
+            # HOT updates are pruned in-page and leave no work for vacuum.
+            changes = max(0, (curr['ins'] + curr['upd'] + curr['del']) - (prev['ins'] + prev['upd'] + prev['del']))
+            produced = max(0, (curr['upd'] - curr['hot_upd']) - (prev['upd'] - prev['hot_upd']) + curr['del'] - prev['del'])
+            dead_rate = max(produced, curr['dead'] - prev['dead']) / float(interval)
+            if not dead_rate:
+                continue
+
+            # Dead rows expected to pile up between two vacuum runs.
+            dead_per_period = dead_rate * self.AUTOVACUUM_PERIOD
+            scale = round(min(max(dead_per_period / max(curr['live'], 1), 0.005), 0.2), 3)
+            if scale >= 0.2:
+                continue
+
+            parameters = [('autovacuum_vacuum_scale_factor', scale),
+                          ('autovacuum_vacuum_threshold', int(min(max(dead_per_period / 10, 50), 10000)))]
+            if dead_per_period > 100000:
+                parameters.append(('autovacuum_vacuum_cost_limit', 2000))
+            elif dead_per_period > 10000:
+                parameters.append(('autovacuum_vacuum_cost_limit', 1000))
+
+            current = dict([option.split('=', 1) for option in curr['options'].split(',') if '=' in option])
+            if [key for key, value in parameters if current.get(key) != str(value)]:
+                advice.append((name, (changes / float(interval), dead_rate, curr['dead']), parameters))
+
+        return advice
+
+
+    def do_autovacuum_tune(self, *args, **params):
+        """
+        Propose per-table autovacuum settings from the measured table churn.
+        @help
+        apply\t\t\tApply proposed settings with ALTER TABLE.
+        --interval=<value>\tSampling interval in seconds. Default: 60.
+        """
+        if not self._get_db_status():
+            raise NotReadyException("Database must be running.")
+
+        try:
+            interval = int(params.get('interval', 60))
+        except ValueError:
+            raise GateException("Interval should be an integer.")
+        if interval < 1:
+            raise GateException("Interval should be at least one second.")
+
+        print >> sys.stdout, "Sampling table activity...\t",
+        sys.stdout.flush()
+        roller = Roller()
+        roller.start()
+
+        first = self._get_table_churn()
+        time.sleep(interval)
+        second = self._get_table_churn()
+        advice = self._autovacuum_advise(first, second, interval)
+
+        roller.stop('finished')
+
+        result = Result([('table', 'Table'), ('change_rate', 'Changes/s', '%.1f'), ('dead_rate', 'Dead/s', '%.1f'),
+                         ('dead', 'Dead'), ('scale_factor', 'Scale'), ('threshold', 'Threshold'), ('cost_limit', 'Cost limit')])
+        for name, (change_rate, dead_rate, dead), parameters in advice:
+            parameters = dict(parameters)
+            result.append(name, change_rate, dead_rate, dead,
+                          parameters['autovacuum_vacuum_scale_factor'],
+                          parameters['autovacuum_vacuum_threshold'],
+                          parameters.get('autovacuum_vacuum_cost_limit'))
+
+        if not advice:
+            print >> sys.stdout, "\nDefault autovacuum settings are sufficient.\n"
+            return result
+
+        if 'apply' not in args:
+            print >> sys.stdout, "Use \"apply\" directive to set these parameters."
+            return result
+
+        print >> sys.stdout, "Applying autovacuum settings...\t",
+        sys.stdout.flush()
+        scenario = []
+        for name, rates, parameters in advice:
+            scenario.append("ALTER TABLE %s SET (%s);" % (name, ', '.join(['%s = %s' % item for item in parameters])))
+        stdout, stderr = self.syscall("sudo", self.get_scenario_template(target='psql').replace('@scenario', '\n'.join(scenario).replace('$', '\$')),
+                                      None, "-u", "postgres", "/bin/bash")
+        errors = [line.strip() for line in (stdout + "\n" + stderr).split("\n") if line.find('ERROR:') > -1]
+        if errors:
+            print >> sys.stdout, "failed"
+            print >> sys.stderr, "Error dump:"
+            print >> sys.stderr, '\n'.join(errors)
+        else:
+            print >> sys.stdout, "done"
+
+        return result
+
+
     def _get_tablespace_size(self, path):
         """
         Get tablespace size in bytes.
         """
-        return long(os.popen('/usr/bin/du -bc %s' % path).readlines()[-1].strip().replace('\t', ' ').split(' ')[0])
+        return long(self.shell_output('/usr/bin/du -bc %s' % path, timeout=0).split("\n")[-1].strip().replace('\t', ' ').split(' ')[0])
 
 
     def _rst_get_backup_root(self, path):
@@ -537,9 +1164,8 @@ class PgSQLGate(BaseGate):
         suffix = '-'.join([str(el).zfill(2) for el in time.localtime()][:6])
         destination_tar = old_data_dir + "/data." + suffix + ".tar.gz"
         tar_command = '/bin/tar -czPf %s %s 2>/dev/null' % (destination_tar, self.config['pcnf_pg_data'])
-        os.system(tar_command)
+        self.shell_call(tar_command, timeout=0)
         roller.stop("finished")
-        time.sleep(1)
         sys.stdout.flush()
 
     def _rst_shutdown_db(self):
@@ -548,10 +1174,9 @@ class PgSQLGate(BaseGate):
         """
         if self._get_db_status():
             self.do_db_stop()
-            self.do_db_status()
+            print >> sys.stdout, self.do_db_status()
             if self._get_db_status():
-                print >> sys.stderr, "Error: Unable to stop database."
-                sys.exit(1)
+                raise GateException("Unable to stop database.")
 
 
     def _rst_replace_new_backup(self, backup_dst):
@@ -581,16 +1206,15 @@ class PgSQLGate(BaseGate):
         pggid = grp.getgrnam('postgres')[2]
         os.chown(temp_dir, pguid, pggid)
         tar_command = '/bin/tar xf %s --directory=%s 2>/dev/null' % (destination_tar, temp_dir)
-        os.system(tar_command)
+        self.shell_call(tar_command, timeout=0)
         #print tar_command
 
         roller.stop("finished")
-        time.sleep(1)
 
         print >> sys.stdout, "Restore cluster:\t ",
         backup_root = self._rst_get_backup_root(temp_dir)
         mv_command = '/bin/mv %s %s' % (backup_root, os.path.dirname(self.config['pcnf_pg_data']) + "/data")
-        os.system(mv_command)
+        self.shell_call(mv_command, timeout=0)
         #print mv_command
         print >> sys.stdout, "finished"
         sys.stdout.flush()
@@ -611,8 +1235,7 @@ class PgSQLGate(BaseGate):
 
         backup_dst, backup_on = self.do_backup_status('--silent')
         if not backup_on:
-            print >> sys.stderr, "No backup snapshots are available."
-            sys.exit(1)
+            raise BackupException("No backup snapshots are available.")
 
         # Check if we have enough space to fit enough copy of the tablespace
         curr_ts_size = self._get_tablespace_size(self.config['pcnf_pg_data'])
@@ -626,8 +1249,7 @@ class PgSQLGate(BaseGate):
 
         # At least 1GB free disk space required *after* restore from the backup
         if disk_size - curr_ts_size - bckp_ts_size < 0x40000000:
-            print >> sys.stderr, "At least 1GB free disk space required after backup restoration."
-            sys.exit(1)
+            raise BackupException("At least 1GB free disk space required after backup restoration.")
 
         # Requirements were met at this point.
         #
@@ -684,7 +1306,7 @@ class PgSQLGate(BaseGate):
                 raise GateException("Cannot start the database!")
 
             if not os.path.exists(backup_dir):
-                os.system('sudo -u postgres /bin/mkdir -p -m 0700 %s' % backup_dir)
+                self.shell_call('sudo -u postgres /bin/mkdir -p -m 0700 %s' % backup_dir)
 
             # first write the archive_command and restart the db
 	    # if we create the base backup after this, we prevent a race
@@ -693,7 +1315,7 @@ class PgSQLGate(BaseGate):
             if conf.get('archive_command', '') != cmd:
                 conf['archive_command'] = cmd
                 conf_bk = self._write_conf(conf_path, **conf)
-                self._restart_db()
+                self._apply_conf('archive_command')
 
             # round robin of base backups
             if os.path.exists(backup_dir + "/base.tar.gz"):
@@ -701,10 +1323,7 @@ class PgSQLGate(BaseGate):
                     os.remove(backup_dir + "/base-old.tar.gz")
                 os.rename(backup_dir + "/base.tar.gz", backup_dir + "/base-old.tar.gz")
 
-            cwd = os.getcwd()
-            os.chdir(self.config.get('pcnf_data_directory', '/var/lib/pgsql'))
-            os.system('sudo -u postgres /usr/bin/pg_basebackup -D %s -Ft -c fast -x -v -P -z' % (backup_dir + "/tmp/"))
-            os.chdir(cwd)
+            self._base_backup(backup_dir + "/tmp/")
 
             if os.path.exists(backup_dir + "/tmp/base.tar.gz"):
                 os.rename(backup_dir + "/tmp/base.tar.gz", backup_dir + "/base.tar.gz")
@@ -717,7 +1336,89 @@ class PgSQLGate(BaseGate):
             if conf.get('archive_command', '') != cmd:
                 conf['archive_command'] = cmd
                 conf_bk = self._write_conf(conf_path, **conf)
-                self._restart_db()
+                self._apply_conf('archive_command')
+
+
+    def _base_backup(self, target):
+        """
+        Take the base backup to the target directory, reporting its progress.
+        """
+        print >> sys.stdout, "Taking the base backup:\t",
+        progress = Progress(operation='backup-hot', status=os.path.join(self.get_state_dir(), "progress.state"))
+        progress.start()
+
+        # Progress of pg_basebackup comes to stderr as "<done>/<total> kB (<percent>%), ..." lines.
+        output = []
+        result = {}
+        try:
+            for stream, line in self._execute(['sudo', '-u', 'postgres', '/usr/bin/pg_basebackup', '-D', target,
+                                               '-Ft', '-c', 'fast', '-x', '-v', '-P', '-z']
+                                              + (self.config.get('cluster_port') and ['-p', self.config['cluster_port']] or []), None, result,
+                                              cwd=self.config.get('pcnf_data_directory', '/var/lib/pgsql')):
+                sizes = re.match('^\s*(\d+)/(\d+) kB', line)
+                if sizes:
+                    progress.update(int(sizes.group(1)) * 0x400, int(sizes.group(2)) * 0x400)
+                elif line.strip():
+                    output.append(line)
+        except GateException:
+            progress.stop('failed')
+            raise
+
+        if result['returncode']:
+            progress.stop('failed')
+            print >> sys.stderr, '\n'.join(output)
+            raise GateException("Unable to take the base backup.")
+        progress.stop('finished')
+
+
+    def _get_setting_contexts(self, *names):
+        """
+        Get contexts of the configuration parameters from pg_settings.
+        Context "postmaster" means the parameter is applied only at the server start.
+        """
+        contexts = {}
+        if not names:
+            return contexts
+
+        stdout, stderr = self.syscall("sudo", self.get_scenario_template(target='psql').replace(
+                '@scenario', "SELECT name, context FROM pg_settings WHERE name IN (%s);"
+                % ', '.join(["'%s'" % name.replace("'", "''") for name in names])),
+                                      None, "-u", "postgres", "/bin/bash")
+        for name, context in self.get_rows(stdout, str, str):
+            contexts[name] = context
+
+        return contexts
+
+
+    def _apply_conf(self, *names):
+        """
+        Apply changed configuration parameters to the database.
+        Configuration is reloaded, unless any of the parameters requires a restart.
+        Client authentication config is always reloadable.
+        """
+        if not self._get_db_status():
+            self.do_db_start()
+            print >> sys.stdout, self.do_db_status()
+            return
+
+        contexts = self._get_setting_contexts(*[name for name in names if name != 'pg_hba.conf'])
+        restart = [name for name in names if name != 'pg_hba.conf' and contexts.get(name, 'postmaster') == 'postmaster']
+        if restart:
+            print >> sys.stdout, "INFO: Database needs to be restarted for:", ', '.join(restart)
+            self._restart_db()
+            return
+
+        print >> sys.stdout, "Reloading configuration...\t",
+        sys.stdout.flush()
+        stdout, stderr = self.syscall("sudo", self.get_scenario_template(target='psql').replace('@scenario', 'SELECT pg_reload_conf();'),
+                                      None, "-u", "postgres", "/bin/bash")
+        if stdout.strip() == 't':
+            print >> sys.stdout, "done"
+        else:
+            print >> sys.stdout, "failed"
+            print >> sys.stderr, "Error dump:"
+            print >> sys.stderr, stdout, stderr
+            raise GateException("Unable to reload the configuration.")
 
 
     def _restart_db(self):
@@ -725,9 +1426,12 @@ class PgSQLGate(BaseGate):
         Restart the entire db.
         """
         if self._get_db_status():
+            # Checkpoint now, so the shutdown checkpoint has little left to flush.
+            self.syscall("sudo", self.get_scenario_template(target='psql').replace('@scenario', 'CHECKPOINT;'),
+                         None, "-u", "postgres", "/bin/bash")
             self.do_db_stop()
         self.do_db_start()
-        self.do_db_status()
+        print >> sys.stdout, self.do_db_status()
 
 
     def _perform_archive_operation(self, **args):
@@ -743,6 +1447,474 @@ class PgSQLGate(BaseGate):
         shutil.copy2(args.get('source'), args.get('backup-dir'))
 
 
+    def _get_priority_prefix(self, priority):
+        """
+        Command prefix, which runs the command with the lower CPU and I/O priority.
+        """
+        if priority not in self.DUMP_PRIORITY:
+            raise GateException("Unknown priority \"%s\". Use one of: %s." % (priority, ', '.join(sorted(self.DUMP_PRIORITY.keys()))))
+
+        prefix = []
+        for command, options in zip(['nice', 'ionice'], self.DUMP_PRIORITY[priority]):
+            if options and utils.which(command):
+                prefix += [utils.which(command)] + options
+
+        return prefix
+
+
+    def _get_dump_toc(self, target):
+        """
+        Get entries of the directory-format dump, which belong to the tables,
+        as (dump ID, type, qualified name) tuples in the restore order.
+        """
+        toc = []
+        for line in self.shell_output("/usr/bin/pg_restore -l '%s'" % target, name='pg_restore').split("\n"):
+            entry = re.match(r'^(\d+); \d+ \d+ (%s) (\S+) (.+) \S+$' % '|'.join(self.DUMP_TYPES), line.strip())
+            if entry:
+                toc.append((int(entry.group(1)), entry.group(2), entry.group(3) + "." + entry.group(4)))
+
+        return toc
+
+
+    def _get_dump_size(self, target, dump_id):
+        """
+        Get bytes of the data file of the dump entry.
+        """
+        for name in ["%s.dat.gz" % dump_id, "%s.dat" % dump_id]:
+            if os.path.exists(os.path.join(target, name)):
+                return os.path.getsize(os.path.join(target, name))
+
+        return 0
+
+
+    def _get_dump_tables(self, target):
+        """
+        Get tables of the directory-format dump from its table of contents.
+        Returns dictionary of the table name: (dump ID, bytes of its data file).
+        """
+        return dict([(name, (dump_id, self._get_dump_size(target, dump_id)))
+                     for dump_id, kind, name in self._get_dump_toc(target) if kind == 'TABLE DATA'])
+
+
+    def do_backup_logical(self, *opts, **args):
+        """
+        Take logical backup of the database as a parallel directory-format dump.
+        @help
+        --backup-dir=<path>\tDirectory of the dumps. Each dump goes to its own subdirectory.
+        --jobs=<value>\tConcurrent dump sessions. Default: half of the CPUs
+        --priority=<value>\tCPU and I/O priority of the dump: normal | low | idle. Default: low
+        """
+        if 'backup-dir' not in args.keys():
+            raise GateException("Where I have to put backups?")
+        if not self.config.get('db_name'):
+            raise GateException("Database name is not set in the configuration as \"db_name\".")
+        if not self._get_db_status():
+            raise NotReadyException("Database must be running.")
+
+        prefix = self._get_priority_prefix(args.get('priority', 'low'))
+        jobs = max(1, int(args.get('jobs', PgTune().get_cpu_count() / 2)))
+        if jobs > 1 and self._get_server_version() < 90200:
+            print >> sys.stderr, "Server has no synchronized snapshots, dumping in one session."
+            jobs = 1
+
+        backup_dir = args['backup-dir']
+        if not os.path.exists(backup_dir):
+            self.shell_call('sudo -u postgres /bin/mkdir -p -m 0700 %s' % backup_dir)
+        target = os.path.join(backup_dir, time.strftime("logical-%Y%m%d-%H%M%S"))
+
+        stdout, stderr = self.call_scenario('pg-tablesizes', target='psql')
+        self.to_stderr(stderr)
+        sizes = dict([(name, size) for name, size_pretty, size in self.get_rows(stdout, str, str, long)])
+
+        print >> sys.stdout, "Dumping the database:\t",
+        progress = Progress(source=lambda: (os.path.exists(target) and utils.get_path_size(target) or 0, None),
+                            operation='backup-logical', status=os.path.join(self.get_state_dir(), "progress.state"))
+        progress.start()
+
+        # Only the last messages of the verbose dump are kept for the failure report
+        output = []
+        result = {}
+        started = time.time()
+        try:
+            for stream, line in self._execute(['sudo', '-u', 'postgres'] + prefix +
+                                              ['/usr/bin/pg_dump', '-Fd', '-j', str(jobs), '-f', target, '-v',
+                                               '--lock-wait-timeout=%ss' % self.DUMP_LOCK_TIMEOUT]
+                                              + (self.config.get('cluster_port') and ['-p', self.config['cluster_port']] or [])
+                                              + [self.config['db_name']], None, result, name='pg_dump'):
+                if line.strip():
+                    output = output[-19:] + [line]
+        except GateException:
+            progress.stop('failed')
+            raise
+
+        if result['returncode']:
+            progress.stop('failed')
+            print >> sys.stderr, '\n'.join(output)
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            raise BackupException("Unable to dump the database.")
+        progress.stop('finished')
+        finished = time.time()
+
+        mb = lambda value: '%.1f' % (value / 1024. / 1024.)
+        report = Result([('table', 'Table'), ('size', 'Size, MB', mb), ('dump_size', 'Dump, MB', mb)])
+        tables = self._get_dump_tables(target)
+        for name, (dump_id, dump_size) in sorted(tables.items(), key=lambda table: -sizes.get(table[0], 0)):
+            report.append(name, sizes.get(name), dump_size)
+        total, dump_total = sum([sizes.get(name, 0) for name in tables]), utils.get_path_size(target)
+        report.footer.append(('Total', mb(total), mb(dump_total),))
+
+        manifest = {
+            'database': self.config['db_name'],
+            'server_version': self._get_server_version(),
+            'format': 'directory',
+            'jobs': jobs,
+            'priority': args.get('priority', 'low'),
+            'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+            'duration': int(finished - started),
+            'size': dump_total,
+            'tables': dict([(name, {'id': dump_id, 'size': sizes.get(name), 'dump_size': dump_size})
+                            for name, (dump_id, dump_size) in tables.items()]),
+        }
+        out = open(os.path.join(target, "manifest.json"), "w")
+        try:
+            json.dump(manifest, out, indent=2, sort_keys=True)
+        finally:
+            out.close()
+        out = open(os.path.join(target, "tables.txt"), "w")
+        try:
+            report.write(out)
+        finally:
+            out.close()
+
+        print >> sys.stdout, "Dump %s: %s tables, %s MB in %d seconds." % (target, len(tables), mb(dump_total), finished - started)
+
+        return report
+
+
+    def _write_dump_list(self, entries):
+        """
+        Write the list of the dump entries to restore, readable by the database user.
+        """
+        fd, path = tempfile.mkstemp(prefix="smdba-restore.", suffix=".list")
+        out = os.fdopen(fd, "w")
+        try:
+            for dump_id, kind, name in entries:
+                out.write("%s; %s %s\n" % (dump_id, kind, name))
+        finally:
+            out.close()
+        os.chmod(path, 0644)
+
+        return path
+
+
+    def _get_dump_relations(self, target, toc):
+        """
+        Find tables of the indexes, constraints, triggers, defaults and sequences of the dump.
+        Returns dictionary of the dump ID: (table, referenced table), the latter is only for the foreign keys.
+        """
+        entries = [entry for entry in toc if entry[1] not in ['TABLE', 'TABLE DATA', 'SEQUENCE', 'SEQUENCE SET']]
+        ids = dict([((kind, name), dump_id) for dump_id, kind, name in entries])
+        statements = {}
+        if entries:
+            listing = self._write_dump_list(entries)
+            try:
+                sql = self.shell_output("/usr/bin/pg_restore -f - -L '%s' '%s'" % (listing, target), name='pg_restore')
+            finally:
+                os.unlink(listing)
+
+            current = None
+            for line in sql.split("\n"):
+                header = re.match(r'^-- Name: (.+); Type: (.+); Schema: (.+?); Owner:', line)
+                if header:
+                    current = ids.get((header.group(2), header.group(3) + "." + header.group(1)))
+                    if current is not None:
+                        statements[current] = [header.group(3), ""]
+                elif current is not None and not line.startswith("--"):
+                    statements[current][1] += line + "\n"
+
+        def qualify(schema, name):
+            name = name.replace('"', '')
+            return name.find('.') > -1 and name or schema + "." + name
+
+        relations = {}
+        for dump_id, (schema, statement) in statements.items():
+            for pattern in [r'^ALTER TABLE (?:ONLY )?(\S+)', r'\bOWNED BY (\S+)\.[^.\s]+;', r'\sON (?:ONLY )?(\S+)\s']:
+                table = re.search(pattern, statement, re.M)
+                if table:
+                    referenced = re.search(r'\bREFERENCES (\S+?)\(', statement)
+                    relations[dump_id] = (qualify(schema, table.group(1)),
+                                          referenced and qualify(schema, referenced.group(1)) or None)
+                    break
+
+        # Sequences are going with the tables, which own them
+        owners = dict([(name, relations[dump_id][0]) for dump_id, kind, name in toc
+                       if kind == 'SEQUENCE OWNED BY' and dump_id in relations])
+        for dump_id, kind, name in toc:
+            if kind in ['SEQUENCE', 'SEQUENCE SET'] and name in owners:
+                relations[dump_id] = (owners[name], None)
+
+        return relations
+
+
+    def _run_sessions(self, tasks, jobs):
+        """
+        Run (size, function) tasks in the concurrent sessions, biggest first.
+        Returns list of errors.
+        """
+        pending = sorted(tasks, key=lambda task: task[0], reverse=True)
+        errors = []
+        def session():
+            while pending:
+                try:
+                    size, task = pending.pop(0)
+                except IndexError:
+                    return # Taken by another session meanwhile
+                try:
+                    task()
+                except Exception, ex:
+                    errors.append(str(ex))
+
+        workers = [Thread(target=session) for idx in range(max(1, min(jobs, len(tasks))))]
+        for worker in workers:
+            share_output(worker)
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        return errors
+
+
+    def _restore_native(self, target, database, jobs, options, objects):
+        """
+        Restore into the database with the parallel pg_restore.
+        Time of each object is taken from the verbose messages and put to the objects
+        dictionary of the dump ID: [start, end].
+        """
+        output = []
+        result = {}
+        current = None
+        for stream, line in self._execute(['sudo', '-u', 'postgres', 'env', 'PGOPTIONS=' + self.RESTORE_OPTIONS,
+                                           '/usr/bin/pg_restore', '-v', '-j', str(jobs), '-d', database]
+                                          + (self.config.get('cluster_port') and ['-p', self.config['cluster_port']] or [])
+                                          + options + [target], None, result, name='pg_restore'):
+            if line.strip():
+                output = output[-19:] + [line]
+
+            # Parallel restore tells the dump IDs, single session tells only the table, which data is loaded.
+            event = re.search(r'\b(launching|finished) item (\d+) ', line)
+            serial = re.search(r'\bprocessing data for table "(.+)"', line)
+            if event and int(event.group(2)) in objects:
+                objects[int(event.group(2))][['launching', 'finished'].index(event.group(1))] = time.time()
+            elif serial or line.find("pg_restore: ") > -1:
+                if current is not None:
+                    objects[current][1] = time.time()
+                    current = None
+                table = serial and serial.group(1).replace('"', '')
+                for dump_id in table and objects.keys() or []:
+                    if objects[dump_id][3] == 'TABLE DATA' and table in [objects[dump_id][2], objects[dump_id][2].split('.', 1)[1]]:
+                        current = dump_id
+                        objects[dump_id][0] = time.time()
+
+        if current is not None:
+            objects[current][1] = time.time()
+        if result['returncode']:
+            print >> sys.stderr, '\n'.join(output)
+            raise BackupException("Unable to restore the dump.")
+
+
+    def _restore_remapped(self, target, database, source, schema, entries):
+        """
+        Restore the entries of the dump, moving them from the source schema to another one.
+        pg_restore cannot do it, so its SQL is rewritten on the way to psql.
+        """
+        listing = self._write_dump_list(entries)
+        try:
+            pipeline = "set -o pipefail; /usr/bin/pg_restore -f - -L %s %s | %s %s %s %s | /usr/bin/psql -X -q -v ON_ERROR_STOP=1 -d %s%s" % (
+                pipes.quote(listing), pipes.quote(target), pipes.quote(sys.executable),
+                pipes.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), "pgschema.py")),
+                pipes.quote(source), pipes.quote(schema), pipes.quote(database),
+                self.config.get('cluster_port') and " -p " + self.config['cluster_port'] or "")
+            output = []
+            result = {}
+            for stream, line in self._execute(['sudo', '-u', 'postgres', 'env', 'PGOPTIONS=' + self.RESTORE_OPTIONS,
+                                               '/bin/bash', '-c', pipeline], None, result, name='pg_restore'):
+                if line.strip():
+                    output = output[-19:] + [line]
+        finally:
+            os.unlink(listing)
+
+        if result['returncode']:
+            raise BackupException("Unable to restore %s:\n%s" % (', '.join([name for dump_id, kind, name in entries]),
+                                                                 '\n'.join(output)))
+
+
+    def _restore_sessions(self, target, database, source, schema, entries, relations, objects, jobs):
+        """
+        Restore the entries into another schema in the concurrent sessions:
+        data of each table and indexes of each table in a session of their own.
+        Data, indexes and constraints are restored one by one, so each of them
+        has its own time in the report.
+        """
+        groups = {}
+        for dump_id, kind, name in entries:
+            if kind == 'TABLE DATA':
+                group = name
+            elif kind in ['INDEX', 'CONSTRAINT', 'TRIGGER']:
+                group = relations[dump_id][0]
+            else:
+                group = None # Restored together in one session
+            groups.setdefault(group, []).append((dump_id, kind, name))
+
+        timed = ['TABLE DATA', 'INDEX', 'CONSTRAINT', 'FK CONSTRAINT']
+        def restore(group):
+            def task():
+                rest = [entry for entry in group if entry[1] not in timed]
+                if rest:
+                    self._restore_remapped(target, database, source, schema, rest)
+                for entry in group:
+                    if entry[1] in timed:
+                        start = time.time()
+                        self._restore_remapped(target, database, source, schema, [entry])
+                        objects[entry[0]][:2] = [start, time.time()]
+            return task
+
+        errors = self._run_sessions([(sum([self._get_dump_size(target, entry[0]) for entry in members]), restore(members))
+                                     for members in groups.values()], jobs)
+        if errors:
+            raise BackupException('\n'.join(errors))
+
+
+    def _psql_command(self, database, sql):
+        """
+        Run SQL command in the given database.
+        Returns stdout and stderr.
+        """
+        return self.syscall("sudo", None, None, "-u", "postgres", "/usr/bin/psql", "-X", "-t", "-A", "-d", database,
+                            *((self.config.get('cluster_port') and ['-p', self.config['cluster_port']] or []) + ['-c', sql]))
+
+
+    def do_backup_logical_restore(self, *opts, **args):
+        """
+        Restore logical backup, taken by backup-logical, in concurrent sessions.
+        @help
+        --backup=<path>\tDirectory of the dump to restore.
+        --target-db=<name>\tDatabase to restore into, created if missing. Default: <database>_restore
+        --tables=<list>\tComma separated tables to restore, like public.rhnserver. Default: all
+        --target-schema=<name>\tSchema of the target database, where the tables are restored.
+        --jobs=<value>\tConcurrent restore sessions. Default: number of CPUs
+        """
+        backup = args.get('backup')
+        if not backup:
+            raise GateException("Which dump I have to restore?")
+        if not os.path.exists(os.path.join(backup, "toc.dat")):
+            raise GateException("Directory %s is not a logical backup." % backup)
+        if not self.config.get('db_name'):
+            raise GateException("Database name is not set in the configuration as \"db_name\".")
+        if not self._get_db_status():
+            raise NotReadyException("Database must be running.")
+
+        database = args.get('target-db', self.config['db_name'] + "_restore")
+        schema = args.get('target-schema')
+        jobs = max(1, int(args.get('jobs', PgTune().get_cpu_count())))
+        toc = self._get_dump_toc(backup)
+        tables = [name for dump_id, kind, name in toc if kind == 'TABLE']
+
+        # Selected tables with their sequences, defaults, indexes, constraints and triggers
+        subset = args.get('tables') or schema
+        if subset:
+            names = args.get('tables') and args['tables'].replace(' ', '').split(',') or tables
+            selected = set([name for name in tables if name in names or name.split('.', 1)[1] in names])
+            unknown = [name for name in names if name not in selected and not [table for table in selected
+                                                                               if table.split('.', 1)[1] == name]]
+            if unknown:
+                raise GateException("Dump has no tables: %s" % ', '.join(unknown))
+            sources = set([name.split('.', 1)[0] for name in selected])
+            if schema and len(sources) > 1:
+                raise GateException("Tables of one schema only can be restored into another schema.")
+
+            relations = self._get_dump_relations(backup, toc)
+            skipped = [name for dump_id, kind, name in toc if kind == 'FK CONSTRAINT' and dump_id in relations
+                       and relations[dump_id][0] in selected and relations[dump_id][1] not in selected]
+            toc = [(dump_id, kind, name) for dump_id, kind, name in toc
+                   if (kind in ['TABLE', 'TABLE DATA'] and name in selected)
+                   or (dump_id in relations and relations[dump_id][0] in selected
+                       and (kind != 'FK CONSTRAINT' or relations[dump_id][1] in selected))]
+            if skipped:
+                print >> sys.stderr, "Foreign keys to the tables, which are not restored, are skipped: %s" % ', '.join(skipped)
+        elif database == self.config['db_name']:
+            raise GateException("Whole dump would clash with the objects of the running database \"%s\". "
+                                "Restore into another database or only some tables into another schema." % database)
+
+        # Target database and schema
+        stdout, stderr = self.syscall("sudo", self.get_scenario_template(target='psql').replace(
+                '@scenario', "SELECT count(*) FROM pg_database WHERE datname = '%s';" % database.replace("'", "''")),
+                                      None, "-u", "postgres", "/bin/bash")
+        self.to_stderr(stderr)
+        if not [count for count, in self.get_rows(stdout, int) if count]:
+            print >> sys.stdout, "Creating database %s" % database
+            stdout, stderr = self.syscall("sudo", self.get_scenario_template(target='psql').replace(
+                    '@scenario', 'CREATE DATABASE "%s" TEMPLATE template0;' % database.replace('"', '""')),
+                                          None, "-u", "postgres", "/bin/bash")
+            self.to_stderr(stderr)
+        if schema:
+            stdout, stderr = self._psql_command(database, "SELECT count(*) FROM pg_namespace WHERE nspname = '%s';"
+                                                % schema.replace("'", "''"))
+            self.to_stderr(stderr)
+            if stdout.strip() == '0':
+                self.to_stderr(self._psql_command(database, 'CREATE SCHEMA "%s";' % schema.replace('"', '""'))[1])
+
+        # Tables are loaded without indexes, constraints and triggers, which are built in bulk afterwards.
+        objects = dict([(dump_id, [None, None, name, kind]) for dump_id, kind, name in toc])
+        phases = [
+            ('Creating tables', 'pre-data', ['TABLE', 'SEQUENCE', 'SEQUENCE OWNED BY', 'DEFAULT']),
+            ('Loading data', 'data', ['TABLE DATA', 'SEQUENCE SET']),
+            ('Building indexes and constraints', 'post-data', ['INDEX', 'CONSTRAINT', 'TRIGGER']),
+            ('Adding foreign keys', None, ['FK CONSTRAINT']),
+        ]
+        started = time.time()
+        for label, section, kinds in phases:
+            entries = [entry for entry in toc if entry[1] in kinds]
+            if subset and not entries or not subset and not section:
+                continue # Nothing to restore, or foreign keys are in the post-data section of the whole dump
+
+            print >> sys.stdout, "%s...\t" % label,
+            sys.stdout.flush()
+            roller = Roller()
+            roller.start()
+            try:
+                if schema:
+                    self._restore_sessions(backup, database, list(sources)[0], schema, entries, relations, objects,
+                                           section != 'pre-data' and jobs or 1)
+                elif subset:
+                    listing = self._write_dump_list(entries)
+                    try:
+                        self._restore_native(backup, database, section != 'pre-data' and jobs or 1, ['-L', listing], objects)
+                    finally:
+                        os.unlink(listing)
+                else:
+                    self._restore_native(backup, database, section != 'pre-data' and jobs or 1, ['--section=' + section], objects)
+            except:
+                roller.stop('failed')
+                raise
+            roller.stop('done')
+
+        mb = lambda value: '%.1f' % (value / 1024. / 1024.)
+        report = Result([('object', 'Object'), ('type', 'Type'), ('size', 'Dump, MB', mb), ('time', 'Time, s', '%.1f'),
+                         ('rate', 'MB/s', '%.1f')])
+        for dump_id, kind, name in toc:
+            start, end = objects[dump_id][:2]
+            if start is None or end is None or kind not in ['TABLE DATA', 'INDEX', 'CONSTRAINT', 'FK CONSTRAINT']:
+                continue
+            size = kind == 'TABLE DATA' and self._get_dump_size(backup, dump_id) or None
+            report.append(name, kind, size, end - start, size is not None and end > start and size / 1024. / 1024. / (end - start) or None)
+
+        print >> sys.stdout, "Restored %s into %s%s in %d seconds." % (subset and "%s tables" % len(selected) or "the dump",
+                                                                     database, schema and "." + schema or "", time.time() - started)
+
+        return report
+
+
     def do_backup_status(self, *opts, **args):
         """
         Show backup status.
@@ -750,7 +1922,6 @@ class PgSQLGate(BaseGate):
         backup_dst = ""
         backup_on = False
         conf_path = self.config['pcnf_pg_data'] + "/postgresql.conf"
-        conf = self._get_conf(conf_path)
         cmd = self._get_conf(conf_path).get('archive_command', '').split(" ")
         found_dest = False
         for comp in cmd:
@@ -761,6 +1932,9 @@ class PgSQLGate(BaseGate):
                 backup_on = os.path.exists(backup_dst)
                 break
 
+        if '--silent' in opts:
+            return backup_dst, backup_on
+
         backup_last_transaction = None
         if backup_dst:
             for fh in os.listdir(backup_dst ):
@@ -771,26 +1945,113 @@ class PgSQLGate(BaseGate):
         space_usage = None
         if backup_dst:
             partition = self._get_partition(backup_dst)
-            for line in os.popen("df -T").readlines()[1:]:
+            for line in self.shell_output("df -T").split("\n")[1:]:
                 line = line.strip()
                 if not line.startswith(partition):
                     continue
                 space_usage = (filter(None, line.split(' '))[5] + '').replace('%', '')
 
-        if not '--silent' in opts:
-            print >> sys.stdout, "Backup status:\t\t", (backup_on and 'ON' or 'OFF')
-            print >> sys.stdout, "Destination:\t\t", (backup_dst or '--')
-            print >> sys.stdout, "Last transaction:\t", backup_last_transaction and time.ctime(backup_last_transaction) or '--'
-            print >> sys.stdout, "Space available:\t", space_usage and str((100 - int(space_usage))) + '%' or '--'
-        else:
-            return backup_dst, backup_on
+        # A full filesystem has 0% available, which still has to be shown
+        space_available = None
+        if space_usage is not None:
+            space_available = 100 - int(space_usage)
+
+        return Result([('status', 'Backup status'), ('destination', 'Destination'),
+                       ('last_transaction', 'Last transaction', time.ctime), ('space_available', 'Space available', '%s%%')],
+                      [(backup_on and 'ON' or 'OFF', backup_dst or None, backup_last_transaction,
+                        space_available)], record=True)
+
+
+    def do_storage_probe(self, *args, **params):
+        """
+        Probe the storage of the data directory and the backup for the tuning.
+        @help
+        --size=<value>\tScratch file size in megabytes. Default: 64.
+        @nl
+        Results are stored and used by "system-check autotuning" afterwards.
+        """
+        try:
+            size = int(params.get('size', 64)) * 0x100000
+        except ValueError:
+            raise GateException("Size should be an integer.")
+
+        # Scratch file has to be on the same filesystem as probed directory.
+        locations = [('data', self.config['pcnf_pg_data'])]
+        backup_dst, backup_on = self.do_backup_status('--silent')
+        if backup_on:
+            locations.append(('backup', backup_dst))
+
+        table = Result([('location', 'Location'), ('device', 'Device'),
+                        ('rotational', 'Rotational', lambda value: value and 'yes' or 'no'),
+                        ('random_iops', 'Random IOPS'), ('random_latency', 'Latency (ms)'),
+                        ('sequential_mbps', 'Sequential (MB/s)'), ('fsync_latency', 'Fsync (ms)')])
+        for name, path in locations:
+            path = self._get_probe_dir(path)
+            if self.media_usage(path)['free'] < size * 4:
+                raise GateException("Not enough free space at \"%s\" to probe the storage." % path)
+
+            print >> sys.stdout, "Probing %s storage...\t" % name,
+            sys.stdout.flush()
+            roller = Roller()
+            roller.start()
+            result = StorageProbe(path, size=size).run()
+            roller.stop(result['direct'] and 'finished' or 'finished, but page cache was measured')
+
+            # Tuner takes the data directory results from the "storage" state.
+            self.save_state(name == 'data' and 'storage' or 'storage-' + name, **result)
+            table.append(name, result['device'], result['rotational'],
+                         result['random_iops'], result['random_latency'], result['sequential_mbps'], result['fsync_latency'])
+
+        print >> sys.stdout, "Results are saved. Run \"system-check autotuning\" to apply them."
+
+        return table
+
+
+    def do_wal_probe(self, *args, **params):
+        """
+        Probe commit latency of the WAL storage with each sync method for the tuning.
+        @help
+        Results are stored and used by "system-check autotuning" afterwards.
+        """
+        wal_dir = os.path.realpath(self.config['pcnf_pg_data'] + (self._get_server_version() >= 100000 and "/pg_wal" or "/pg_xlog"))
+        probe_dir = self._get_probe_dir(wal_dir)
+
+        print >> sys.stdout, "Probing WAL storage...\t",
+        sys.stdout.flush()
+        roller = Roller()
+        roller.start()
+        results = WALSyncProbe(probe_dir).run()
+        roller.stop('finished')
+
+        fastest = max(results.values())
+        table = Result([('method', 'Sync method'), ('ops', 'Ops/sec'), ('latency', 'Latency (ms)', '%.3f'),
+                        ('fastest', '', lambda value: value and 'fastest' or '')])
+        for method in sorted(results.keys()):
+            table.append(method, results[method], round(1000. / max(results[method], 1), 3), results[method] == fastest)
+
+        self.save_state('wal', **results)
+        print >> sys.stdout, "Results are saved. Run \"system-check autotuning\" to apply them."
+
+        return table
+
+
+    def _get_probe_dir(self, path):
+        """
+        Get directory for the probe scratch files on the same filesystem as the path.
+        State directory is preferred to keep the scratch files away from the database.
+        """
+        state_dir = self.get_state_dir()
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir, 0700)
+
+        return os.stat(state_dir).st_dev == os.stat(path).st_dev and state_dir or path
 
 
     def _get_partition_size(self, path):
         """
         Get a size of the partition, where path belongs to."
         """
-        return long((filter(None, (os.popen("df -TB1 %s" % path).readlines()[-1] + '').split(' '))[4] + '').strip())
+        return long((filter(None, (self.shell_output("df -TB1 %s" % path).split("\n")[-1] + '').split(' '))[4] + '').strip())
 
 
     def do_system_check(self, *args, **params):
@@ -804,7 +2065,7 @@ class PgSQLGate(BaseGate):
         # Check hot backup setup and clean it up automatically
         conf_path = self.config['pcnf_pg_data'] + "/postgresql.conf"
         conf = self._get_conf(conf_path)
-        changed = False
+        original = dict(conf)
 
         #
         # Setup postgresql.conf
@@ -812,10 +2073,18 @@ class PgSQLGate(BaseGate):
 
         # Built-in tuner
         if 'autotuning' in args:
-            for item, value in PgTune().estimate().config.items():
-                if not changed and str(conf.get(item, None)) != str(value):
-                    changed = True
+            tune = PgTune(self._get_server_version(), self._get_workload(), self.load_state('storage'),
+                          self.load_state('wal')).estimate()
+            for item in tune.obsolete:
+                if item in conf:
+                    del conf[item]
+
+            table = [('Setting', 'Value', 'Reason',)]
+            for item in sorted(tune.config.keys()):
+                value = tune.config[item]
                 conf[item] = value
+                table.append((item, value, tune.reasons[item],))
+            print >> sys.stdout, "\n", TablePrint(table), "\n"
 
         # WAL should be at least archive.
         if not conf.get('wal_level') or conf.get('wal_level') == 'minimal':
@@ -824,32 +2093,26 @@ class PgSQLGate(BaseGate):
         # WAL senders at least 5
         if not conf.get('max_wal_senders') or conf.get('max_wal_senders') < '5':
             conf['max_wal_senders'] = 5
-            changed = True
 
         # WAL keep segments must be non-zero
         if conf.get('wal_keep_segments', '0') == '0':
             conf['wal_keep_segments'] = 64
-            changed = True
 
         # Should run in archive mode
         if conf.get('archive_mode', 'off') != 'on':
             conf['archive_mode'] = 'on'
-            changed = True
 
         # Stub
         if conf.get('archive_command', '') != "'/bin/true'":
             conf['archive_command'] = "'/bin/true'"
-            changed = True
 
         # [Spacewalk-devel] option standard_conforming_strings in Pg breaks our code and data.
         if conf.get('standard_conforming_strings', 'on') != "'off'":
             conf['standard_conforming_strings'] = "'off'"
-            changed = True
 
         # bnc#775591
         if conf.get('bytea_output', '') != "'escape'":
             conf['bytea_output'] = "'escape'"
-            changed = True
 
         #
         # Setup pg_hba.conf
@@ -872,8 +2135,9 @@ class PgSQLGate(BaseGate):
         #
         # Commit the changes
         #
+        changed = sorted([item for item in set(original.keys() + conf.keys())
+                          if str(original.get(item)) != str(conf.get(item))])
         if changed or hba_changed:
-            print >> sys.stdout, "INFO: Database needs to be restarted."
             if changed:
                 conf_bk = self._write_conf(conf_path, **conf)
                 if conf_bk:
@@ -885,11 +2149,8 @@ class PgSQLGate(BaseGate):
                 if conf_bk:
                     print >> sys.stdout, "INFO: Wrote new client auth configuration. Backup as", conf_bk
 
-            # Restart
-            if self._get_db_status():
-                self.do_db_stop()
-            self.do_db_start()
-            self.do_db_status()
+            # Reload or restart. Removed parameters are obsolete and unknown to the server.
+            self._apply_conf(*([item for item in changed if item in conf] + (hba_changed and ['pg_hba.conf'] or [])))
         else:
             print >> sys.stdout, "INFO: No changes required."
 
@@ -898,6 +2159,76 @@ class PgSQLGate(BaseGate):
         return True
 
 
+    def get_collectors(self):
+        """
+        Metric collectors, from the cheapest and most often refreshed.
+        """
+        self._archive = {}
+        self._archive_checked = None
+        return [Collector('database', 15, self._collect_database),
+                Collector('backup', 60, self._collect_backup),
+                Collector('space', 300, self._collect_space),
+                Collector('maintenance', 900, self._collect_maintenance)]
+
+
+    def _collect_database(self):
+        yield 'smdba_database_up', {}, int(self._get_db_status())
+
+
+    def _collect_backup(self):
+        """
+        Backup and WAL archive metrics. Only new archive files are looked at,
+        since archived segments are never changed.
+        """
+        backup_dst, backup_on = self.do_backup_status('--silent')
+        yield 'smdba_backup_enabled', {}, int(backup_on)
+        if not backup_on:
+            return
+
+        if os.path.exists(backup_dst + "/base.tar.gz"):
+            yield 'smdba_backup_age_seconds', {}, int(time.time() - os.path.getmtime(backup_dst + "/base.tar.gz"))
+
+        names = set([name for name in os.listdir(backup_dst) if not name.startswith('base')])
+        for name in set(self._archive.keys()) - names:
+            del self._archive[name]
+        added = 0
+        for name in names - set(self._archive.keys()):
+            path = os.path.join(backup_dst, name)
+            if os.path.isfile(path):
+                self._archive[name] = (os.path.getsize(path), os.path.getmtime(path))
+                added += self._archive[name][0]
+
+        now = time.time()
+        if self._archive:
+            yield 'smdba_archive_lag_seconds', {}, int(now - max([mtime for size, mtime in self._archive.values()]))
+        yield 'smdba_archive_bytes', {}, sum([size for size, mtime in self._archive.values()])
+        if self._archive_checked:
+            yield 'smdba_archive_rate_bytes', {}, round(added / max(now - self._archive_checked, 1), 1)
+        self._archive_checked = now
+
+
+    def _collect_space(self):
+        locations = [('data', self.config['pcnf_pg_data'])]
+        backup_dst, backup_on = self.do_backup_status('--silent')
+        if backup_on:
+            locations.append(('backup', backup_dst))
+        for name, path in locations:
+            yield 'smdba_filesystem_free_bytes', {'location': name}, self.media_usage(path)['free']
+        for name, size, available, usage in self.do_space_overview().rows:
+            yield 'smdba_tablespace_size_bytes', {'tablespace': name}, size
+            yield 'smdba_tablespace_usage_percent', {'tablespace': name}, usage
+
+
+    def _collect_maintenance(self):
+        tables = self._get_stats_status()
+        yield 'smdba_stats_stale_tables', {}, len([name for name, size, status in tables if status == 'stale'])
+        yield 'smdba_stats_empty_tables', {}, len([name for name, size, status in tables if status == 'empty'])
+
+        churn = self._get_table_churn()
+        yield 'smdba_live_tuples', {}, sum([table['live'] for table in churn.values()])
+        yield 'smdba_dead_tuples', {}, sum([table['dead'] for table in churn.values()])
+
+
     def startup(self):
         """
         Hooks before the PostgreSQL gate operations starts.
@@ -918,3 +2249,35 @@ def getGate(config):
     Get gate to the database engine.
     """
     return PgSQLGate(config)
+
+
+def getClusters(config, names=None):
+    """
+    Get gates to the clusters on this host, set in the config as
+    "db_clusters = name:data_directory:port, ...". Names are selecting some of them.
+    Returns list of (name, gate) tuples.
+    """
+    clusters = []
+    for cluster in filter(None, config.get('db_clusters', '').replace(' ', '').split(',')):
+        try:
+            name, data, port = cluster.split(':')
+            int(port)
+        except ValueError:
+            raise GateException('Wrong cluster "%s" in the configuration. Use "name:data_directory:port".' % cluster)
+        clusters.append((name, data, port))
+
+    if not clusters:
+        raise GateException('No clusters are set in the configuration as "db_clusters".')
+
+    unknown = set(names or []) - set([cluster[0] for cluster in clusters])
+    if unknown:
+        raise GateException("Unknown clusters: %s" % ', '.join(sorted(unknown)))
+
+    gates = []
+    for name, data, port in clusters:
+        if not names or name in names:
+            cluster_config = dict(config)
+            cluster_config.update({'cluster_name': name, 'cluster_data': data, 'cluster_port': port})
+            gates.append((name, PgSQLGate(cluster_config)))
+
+    return gates
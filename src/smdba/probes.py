@@ -0,0 +1,290 @@
+# Local probes of the system resources
+#
+#
+# The MIT License (MIT)
+# Copyright (C) 2012 SUSE Linux Products GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import os
+import io
+import mmap
+import time
+import random
+
+
+class StorageProbe:
+    """
+    Short and bounded I/O probe of the filesystem, where the path belongs to.
+    """
+    BLOCK = 0x2000     # Database page
+    CHUNK = 0x100000   # Sequential read request
+
+
+    def __init__(self, path, size=0x4000000, duration=2.0):
+        """
+        Path is a directory for the scratch file of the given size in bytes.
+        Duration is a time limit in seconds of each test.
+        """
+        self.path = path
+        self.size = size - size % self.CHUNK
+        self.duration = duration
+        self.direct = hasattr(os, 'O_DIRECT')
+
+
+    def _open(self, scratch, flags):
+        """
+        Open the scratch file, bypassing the page cache when possible.
+        """
+        if self.direct:
+            try:
+                return io.FileIO(os.open(scratch, flags | os.O_DIRECT), flags & os.O_WRONLY and 'w' or 'r')
+            except OSError:
+                # Filesystem, like tmpfs, does not support direct I/O
+                self.direct = False
+
+        return io.FileIO(os.open(scratch, flags), flags & os.O_WRONLY and 'w' or 'r')
+
+
+    def _prepare(self, scratch):
+        """
+        Write the scratch file.
+        """
+        buff = mmap.mmap(-1, self.CHUNK)
+        buff.write(os.urandom(self.CHUNK))
+        fh = self._open(scratch, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            for idx in range(self.size / self.CHUNK):
+                fh.write(buff)
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+            buff.close()
+
+
+    def _random_read(self, scratch):
+        """
+        Random reads of single pages.
+        Returns IOPS and average latency in milliseconds.
+        """
+        buff = mmap.mmap(-1, self.BLOCK)
+        fh = self._open(scratch, os.O_RDONLY)
+        blocks = self.size / self.BLOCK
+        ops = 0
+        try:
+            start = time.time()
+            while time.time() - start < self.duration:
+                fh.seek(random.randint(0, blocks - 1) * self.BLOCK)
+                fh.readinto(buff)
+                ops += 1
+            elapsed = time.time() - start
+        finally:
+            fh.close()
+            buff.close()
+
+        return ops / elapsed, elapsed * 1000. / max(ops, 1)
+
+
+    def _sequential_read(self, scratch):
+        """
+        Sequential read of the whole scratch file.
+        Returns throughput in megabytes per second.
+        """
+        buff = mmap.mmap(-1, self.CHUNK)
+        fh = self._open(scratch, os.O_RDONLY)
+        done = 0
+        try:
+            start = time.time()
+            while done < self.size and time.time() - start < self.duration:
+                done += fh.readinto(buff)
+            elapsed = time.time() - start
+        finally:
+            fh.close()
+            buff.close()
+
+        return done / float(0x100000) / elapsed
+
+
+    def _fsync_latency(self, scratch):
+        """
+        Page writes, each followed by the data synchronization.
+        Returns average latency in milliseconds.
+        """
+        buff = mmap.mmap(-1, self.BLOCK)
+        buff.write(os.urandom(self.BLOCK))
+        fh = self._open(scratch, os.O_WRONLY)
+        ops = 0
+        try:
+            start = time.time()
+            while time.time() - start < self.duration and ops < 1000:
+                fh.seek((ops % (self.size / self.BLOCK)) * self.BLOCK)
+                fh.write(buff)
+                os.fdatasync(fh.fileno())
+                ops += 1
+            elapsed = time.time() - start
+        finally:
+            fh.close()
+            buff.close()
+
+        return elapsed * 1000. / max(ops, 1)
+
+
+    def get_device(self):
+        """
+        Get block device of the path, as it is known in /sys/block.
+        """
+        dev = os.stat(self.path).st_dev
+        sysdev = os.path.realpath('/sys/dev/block/%s:%s' % (os.major(dev), os.minor(dev)))
+        if not os.path.exists(sysdev + "/queue") and os.path.exists(os.path.dirname(sysdev) + "/queue"):
+            sysdev = os.path.dirname(sysdev) # Partition of the disk
+
+        return os.path.exists(sysdev + "/queue") and os.path.basename(sysdev) or None
+
+
+    def get_rotational(self):
+        """
+        Returns True for spinning disks, False for solid state and None if unknown.
+        """
+        device = self.get_device()
+        if device and os.path.exists("/sys/block/%s/queue/rotational" % device):
+            return open("/sys/block/%s/queue/rotational" % device).read().strip() == '1'
+
+        return None
+
+
+    def run(self):
+        """
+        Run all tests and return results as a dictionary.
+        """
+        scratch = os.path.join(self.path, ".smdba-probe.%s" % os.getpid())
+        try:
+            self._prepare(scratch)
+            iops, latency = self._random_read(scratch)
+            throughput = self._sequential_read(scratch)
+            fsync = self._fsync_latency(scratch)
+        finally:
+            if os.path.exists(scratch):
+                os.unlink(scratch)
+
+        return {
+            'device': self.get_device() or 'unknown',
+            'rotational': self.get_rotational(),
+            'direct': self.direct,
+            'random_iops': int(iops),
+            'random_latency': round(latency, 3),
+            'sequential_mbps': int(throughput),
+            'fsync_latency': round(fsync, 3),
+        }
+
+
+
+class WALSyncProbe:
+    """
+    Commit latency probe of the WAL filesystem, similar to pg_test_fsync.
+    Measures single page writes per second with each sync method.
+    """
+    BLOCK = 0x2000
+    SEGMENT = 0x1000000
+
+
+    def __init__(self, path, duration=2.0):
+        """
+        Path is a directory for the scratch segment.
+        Duration is a time limit in seconds of each method.
+        """
+        self.path = path
+        self.duration = duration
+
+
+    def get_methods(self):
+        """
+        Get sync methods, available on this platform, by their wal_sync_method names.
+        """
+        methods = []
+        if hasattr(os, 'fdatasync'):
+            methods.append('fdatasync')
+        methods.append('fsync')
+        if hasattr(os, 'O_DSYNC'):
+            methods.append('open_datasync')
+        if hasattr(os, 'O_SYNC'):
+            methods.append('open_sync')
+
+        return methods
+
+
+    def _prepare(self, scratch):
+        """
+        Write the scratch segment, so writes are going to already allocated space like in recycled WAL.
+        """
+        fh = open(scratch, 'wb')
+        try:
+            for idx in range(self.SEGMENT / self.BLOCK):
+                fh.write('\0' * self.BLOCK)
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+
+
+    def _measure(self, scratch, method):
+        """
+        Returns operations per second of the sync method.
+        """
+        flags = os.O_WRONLY
+        if method == 'open_datasync':
+            flags |= os.O_DSYNC
+        elif method == 'open_sync':
+            flags |= os.O_SYNC
+
+        block = os.urandom(self.BLOCK)
+        fd = os.open(scratch, flags)
+        ops = 0
+        try:
+            start = time.time()
+            while time.time() - start < self.duration:
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, block)
+                if method == 'fdatasync':
+                    os.fdatasync(fd)
+                elif method == 'fsync':
+                    os.fsync(fd)
+                ops += 1
+            elapsed = time.time() - start
+        finally:
+            os.close(fd)
+
+        return ops / elapsed
+
+
+    def run(self):
+        """
+        Run all methods and return operations per second of each.
+        """
+        scratch = os.path.join(self.path, ".smdba-walprobe.%s" % os.getpid())
+        results = {}
+        try:
+            self._prepare(scratch)
+            for method in self.get_methods():
+                results[method] = int(self._measure(scratch, method))
+        finally:
+            if os.path.exists(scratch):
+                os.unlink(scratch)
+
+        return results
@@ -25,11 +25,21 @@
 # IN THE SOFTWARE. 
 # 
 
+import os
 import time
 import sys
 import threading
 
 
+def share_output(thread):
+    """
+    Output of the thread goes where the output of the thread, which starts it.
+    """
+    for stream in [sys.stdout, sys.stderr]:
+        if hasattr(stream, 'share'):
+            stream.share(thread)
+
+
 #
 # Infinite progress bar for console.
 #
@@ -41,24 +51,34 @@ class Roller(threading.Thread):
     Roller of some fun sequences while waiting.
     """
 
+    # Started and not yet stopped rollers
+    active = []
+
     def __init__(self):
         threading.Thread.__init__(self)
+        self.daemon = True
         self.__sequence = ['-', '\\', '|', '/',]
         self.__freq = .1
         self.__offset = 0
-        self.__running = False
+        self.__stopped = threading.Event()
         self.__message = None
 
 
+    def start(self):
+        self.owner = threading.current_thread()
+        Roller.active.append(self)
+        share_output(self)
+        threading.Thread.start(self)
+
+
     def run(self):
-        self.__running = True
-        while self.__running:
+        while not self.__stopped.is_set():
             if self.__offset > len(self.__sequence) - 1:
                 self.__offset = 0
 
             sys.stdout.write("\b" + self.__sequence[self.__offset])
             sys.stdout.flush()
-            time.sleep(self.__freq)
+            self.__stopped.wait(self.__freq)
 
             self.__offset += 1
 
@@ -67,9 +87,199 @@ class Roller(threading.Thread):
 
 
     def stop(self, message=None):
+        """
+        Stop rolling and print the message.
+        Returns when the message is already on the screen.
+        """
         self.__message = message and message or "  "
-        self.__running = False
+        self.__stopped.set()
+        if self.ident is not None:
+            self.join()
         self.__offset = 0
+        if self in Roller.active:
+            Roller.active.remove(self)
+
+
+    @staticmethod
+    def stop_all(message="failed", owner=None):
+        """
+        Stop rollers, left behind by an interrupted operation.
+        Owner is the thread, which has started the rollers to stop.
+        """
+        for roller in Roller.active[:]:
+            if owner is None or roller.owner is owner:
+                roller.stop(message)
+
+
+
+class Progress(threading.Thread):
+    """
+    Progress of the long operation: percentage, throughput and ETA.
+    Figures are given by update() or polled from the source callable,
+    which returns a tuple of done and total bytes. Total is None, if unknown.
+    The same figures are written to the status file for the monitoring.
+    """
+
+    def __init__(self, source=None, status=None, operation=None, poll=5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.__source = source
+        self.__status = status
+        self.__operation = operation
+        self.__poll = poll
+        self.__freq = .5
+        self.__stopped = threading.Event()
+        self.__lock = threading.Lock()
+        self.__message = None
+        self.__text = ''
+        self.__base = None
+        self.done = 0
+        self.total = None
+
+
+    def start(self):
+        share_output(self)
+        threading.Thread.start(self)
+
+
+    def update(self, done, total=None):
+        """
+        Set bytes done out of total.
+        Throughput is measured again, if the total has been changed.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__base is None or total != self.total or done < self.done:
+                self.__base = (time.time(), done)
+            self.done = done
+            self.total = total
+        finally:
+            self.__lock.release()
+
+
+    def get_figures(self):
+        """
+        Returns percentage, throughput in bytes per second and ETA in seconds.
+        Unknown figures are None.
+        """
+        self.__lock.acquire()
+        try:
+            percent = rate = eta = None
+            if self.total:
+                percent = min(self.done * 100. / self.total, 100.)
+            if self.__base is not None and time.time() - self.__base[0] > 0:
+                rate = (self.done - self.__base[1]) / (time.time() - self.__base[0])
+            if rate and self.total:
+                eta = max(self.total - self.done, 0) / rate
+        finally:
+            self.__lock.release()
+
+        return percent, rate, eta
+
+
+    def _render(self):
+        """
+        Render the figures as a single line.
+        """
+        percent, rate, eta = self.get_figures()
+        out = []
+        if percent is not None:
+            out.append("%.1f%%" % percent)
+        else:
+            out.append("%.1f MB" % (self.done / float(0x100000)))
+        if rate is not None:
+            out.append("%.2f MB/s" % (rate / 0x100000))
+        if eta is not None:
+            out.append("ETA %d:%02d:%02d" % (eta / 3600, eta % 3600 / 60, eta % 60))
+
+        return ', '.join(out)
+
+
+    def _save(self, status):
+        """
+        Write the status file, replacing the previous one at once.
+        """
+        if not self.__status:
+            return
+
+        percent, rate, eta = self.get_figures()
+        data = {
+            'operation': self.__operation or '',
+            'status': status,
+            'done': self.done,
+            'total': self.total is not None and self.total or '',
+            'percent': percent is not None and "%.1f" % percent or '',
+            'rate': rate is not None and "%d" % rate or '',
+            'eta': eta is not None and "%d" % eta or '',
+            'updated': int(time.time()),
+        }
+        try:
+            if not os.path.exists(os.path.dirname(self.__status)):
+                os.makedirs(os.path.dirname(self.__status), 0700)
+            fh = open(self.__status + ".tmp", 'w')
+            for key in sorted(data.keys()):
+                fh.write("%s = %s\n" % (key, data[key]))
+            fh.close()
+            os.rename(self.__status + ".tmp", self.__status)
+        except (IOError, OSError):
+            # Monitoring is not a reason to break the operation
+            pass
+
+
+    def _write(self, text):
+        """
+        Replace previously written text on the screen.
+        """
+        pad = max(len(self.__text) - len(text), 0)
+        sys.stdout.write("\b" * len(self.__text) + text + " " * pad + "\b" * pad)
+        sys.stdout.flush()
+        self.__text = text
+
+
+    def run(self):
+        polled = 0
+        while not self.__stopped.is_set():
+            if self.__source is not None and time.time() - polled >= self.__poll:
+                polled = time.time()
+                try:
+                    self.update(*self.__source())
+                except Exception:
+                    pass # Source is not available at the moment
+            self._write(self._render())
+            self._save('running')
+            self.__stopped.wait(self.__freq)
+
+        self._write('')
+        print >> sys.stdout, self.__message
+        sys.stdout.flush()
+        self._save(self.__message)
+
+
+    def stop(self, message=None):
+        """
+        Stop reporting and print the message.
+        Returns when the message is already on the screen.
+        """
+        self.__message = message and message or "  "
+        self.__stopped.set()
+        if self.ident is not None:
+            self.join()
+
+
+
+def wait_for(condition, timeout=60, delay=0.05, max_delay=2):
+    """
+    Wait until the condition callable returns True, checking it with the
+    exponential backoff. Returns False, if the timeout in seconds expired.
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() >= deadline:
+            return False
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+        delay = min(delay * 2, max_delay)
+
+    return True
 
 
 
@@ -82,5 +292,4 @@ if __name__ == '__main__':
     roller.start()
     time.sleep(5)
     roller.stop("finished")
-    time.sleep(1)
     print >> sys.stdout, "OK"
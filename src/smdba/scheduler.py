@@ -0,0 +1,253 @@
+# Maintenance scheduler
+#
+#
+# The MIT License (MIT)
+# Copyright (C) 2012 SUSE Linux Products GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import os
+import sys
+import time
+import shlex
+import ConfigParser
+
+from basegate import GateException
+from basegate import TimeoutException
+from utils import HostLock
+
+
+class Job:
+    """
+    Maintenance job: a command, allowed to run once per its window.
+    """
+
+    DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+    def __init__(self, name, command, window="00:00-24:00", days=None, max_duration=0, group="maintenance", max_load=None):
+        """
+        Window is "HH:MM-HH:MM" of the local time and may pass midnight.
+        Days are the week days, when the window opens. Max duration is in minutes, 0 means no limit.
+        Jobs of the same group are never running at the same time on the host.
+        """
+        self.name = name
+        self.command = shlex.split(command)
+        self.window = self._parse_window(window)
+        self.days = days and [day.strip().lower()[:3] for day in days.split(",")] or self.DAYS[:]
+        self.max_duration = int(max_duration) * 60
+        self.group = group
+        self.max_load = max_load is not None and float(max_load) or None
+
+        if not self.command:
+            raise GateException("Job \"%s\" has no command." % name)
+        if [day for day in self.days if day not in self.DAYS]:
+            raise GateException("Job \"%s\" has unknown days: %s" % (name, days))
+
+
+    def _parse_window(self, window):
+        """
+        Parse window to the minutes of the day, when it opens and closes.
+        """
+        try:
+            limits = []
+            for limit in window.split("-"):
+                hours, minutes = map(int, limit.strip().split(":"))
+                if not (0 <= hours <= 24 and 0 <= minutes < 60):
+                    raise ValueError(limit)
+                limits.append(hours * 60 + minutes)
+            opens, closes = limits
+            if opens == closes:
+                raise ValueError(window)
+        except ValueError:
+            raise GateException("Job \"%s\" has wrong window: %s" % (self.name, window))
+
+        return opens, closes
+
+
+    def get_window_start(self, now):
+        """
+        Get time, when the window, which is open now, has been opened.
+        Returns None, if the window is closed.
+        """
+        opens, closes = self.window
+        today = time.localtime(now)
+        midnight = time.mktime(today[:3] + (0, 0, 0) + today[6:8] + (-1,))
+        minute = today.tm_hour * 60 + today.tm_min
+
+        if opens < closes:
+            start = opens <= minute < closes and midnight + opens * 60 or None
+        elif minute >= opens:
+            start = midnight + opens * 60
+        elif minute < closes:
+            start = midnight - 86400 + opens * 60 # Opened yesterday
+        else:
+            start = None
+
+        if start is not None and self.DAYS[time.localtime(start).tm_wday] not in self.days:
+            start = None
+
+        return start
+
+
+
+class Scheduler:
+    """
+    Runs the jobs in their windows one by one, each as a separate console process.
+    """
+
+    # Seconds between the checks of the jobs
+    INTERVAL = 60
+
+
+    def __init__(self, gate, console_location, jobs):
+        self.gate = gate
+        self.console_location = console_location
+        self.jobs = jobs
+        self.deferred = {}
+        self.last_run = dict([(name, float(start)) for name, start in self.gate.load_state('schedule').items()])
+
+
+    @staticmethod
+    def read_jobs(path):
+        """
+        Read jobs from the INI file, one section per job.
+        """
+        if not os.path.exists(path):
+            raise GateException("Cannot open jobs file: %s" % path)
+
+        config = ConfigParser.RawConfigParser()
+        try:
+            config.read(path)
+        except ConfigParser.Error, ex:
+            raise GateException("Cannot read jobs file %s: %s" % (path, ex))
+
+        jobs = []
+        for name in config.sections():
+            options = dict(config.items(name))
+            if not options.get('command'):
+                raise GateException("Job \"%s\" has no command." % name)
+            unknown = set(options.keys()) - set(['command', 'window', 'days', 'max_duration', 'group', 'max_load'])
+            if unknown:
+                raise GateException("Job \"%s\" has unknown options: %s" % (name, ', '.join(sorted(unknown))))
+            try:
+                jobs.append(Job(name, **options))
+            except ValueError, ex:
+                raise GateException("Job \"%s\" has wrong value: %s" % (name, ex))
+
+        if not jobs:
+            raise GateException("Jobs file %s has no jobs." % path)
+
+        return jobs
+
+
+    def get_load(self):
+        """
+        Get system load average of the last minute.
+        """
+        return os.getloadavg()[0]
+
+
+    def get_max_load(self, job):
+        """
+        Load, above which the job is deferred. Default is the number of CPUs.
+        """
+        return job.max_load or os.sysconf('SC_NPROCESSORS_ONLN')
+
+
+    def record(self, job, outcome, duration, note=""):
+        """
+        Add the run of the job to the history.
+        """
+        entry = "%s\t%s\t%s\t%.0f\t%s" % (time.strftime("%Y-%m-%d %H:%M:%S"), job.name, outcome, duration, note)
+        history = open(os.path.join(self.gate.get_state_dir(), "schedule.history"), "a")
+        try:
+            history.write(entry + "\n")
+        finally:
+            history.close()
+        print >> sys.stdout, entry.strip()
+        sys.stdout.flush()
+
+
+    def run_job(self, job):
+        """
+        Run the job in the console process, unless the command is finished in time.
+        Returns the outcome.
+        """
+        outcome = 'failed'
+        result = {}
+        start = time.time()
+        try:
+            try:
+                for stream, line in self.gate._execute([sys.executable, self.console_location] + job.command, None, result,
+                                                       name='smdba', timeout=job.max_duration):
+                    print >> (stream == 'stdout' and sys.stdout or sys.stderr), "[%s] %s" % (job.name, line)
+                outcome = result.get('returncode') and 'failed' or 'done'
+            except TimeoutException:
+                outcome = 'timeout'
+        finally:
+            self.record(job, outcome, time.time() - start)
+
+        return outcome
+
+
+    def check(self, now):
+        """
+        Run jobs, which are due now, when the load is low and their group is free.
+        Job, which could not run until its window is closed, is recorded as skipped.
+        """
+        for job in self.jobs:
+            start = job.get_window_start(now)
+            if start is None or self.last_run.get(job.name, 0) >= start:
+                if job.name in self.deferred and start is None:
+                    self.record(job, 'skipped', 0, self.deferred.pop(job.name))
+                continue
+
+            load = self.get_load()
+            if load > self.get_max_load(job):
+                self.deferred[job.name] = "load %.2f" % load
+                continue
+
+            lock = HostLock(job.group)
+            if not lock.acquire(owner=job.name):
+                self.deferred[job.name] = "group %s is busy: %s" % (job.group, lock.get_owner())
+                continue
+
+            try:
+                self.deferred.pop(job.name, None)
+                self.last_run[job.name] = now
+                self.gate.save_state('schedule', **dict([(name, "%.0f" % value) for name, value in self.last_run.items()]))
+                self.run_job(job)
+            finally:
+                lock.release()
+            now = time.time()
+
+
+    def run(self):
+        """
+        Check the jobs every minute until stopped.
+        """
+        # Jobs are run by the own console processes, so they are terminated on time
+        os.environ['SMDBA_SOCKET'] = ''
+        print >> sys.stdout, "Scheduled jobs: %s" % ', '.join([job.name for job in self.jobs])
+        sys.stdout.flush()
+        while True:
+            self.check(time.time())
+            time.sleep(self.INTERVAL - time.time() % self.INTERVAL)
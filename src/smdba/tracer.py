@@ -0,0 +1,118 @@
+# Tracing of the external calls
+#
+#
+# The MIT License (MIT)
+# Copyright (C) 2012 SUSE Linux Products GmbH
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import os
+import sys
+import time
+import json
+import threading
+from utils import TablePrint
+
+
+class Tracer:
+    """
+    Recorder of the external calls and gate commands with their timing.
+    Exports Chrome trace events and a summary table.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.events = []
+        self.__lock = threading.Lock()
+
+
+    def _get_caller(self):
+        """
+        Get the gate method, which issued the call.
+        """
+        frame = sys._getframe(2)
+        while frame and os.path.basename(frame.f_code.co_filename).split('.')[0] in ['basegate', 'tracer']:
+            frame = frame.f_back
+
+        return frame and frame.f_code.co_name or 'unknown'
+
+
+    def add(self, category, name, start, duration, **args):
+        """
+        Record an event, which started at the given time and lasted duration seconds.
+        """
+        self.__lock.acquire()
+        try:
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int((start - self.started) * 1000000),
+                'dur': int(duration * 1000000),
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': args,
+            })
+        finally:
+            self.__lock.release()
+
+
+    def call(self, name, args):
+        """
+        Start tracing of an external call.
+        Returns a function to finish it with bytes of output and exit code.
+        """
+        start = time.time()
+        caller = self._get_caller()
+        def finish(output, returncode):
+            self.add('call', name, start, time.time() - start, command=' '.join(args)[:0x200],
+                     caller=caller, output=output, returncode=returncode)
+
+        return finish
+
+
+    def save(self, path):
+        """
+        Save events in the Chrome trace event format.
+        """
+        fh = open(path, 'w')
+        try:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fh)
+        finally:
+            fh.close()
+
+
+    def get_summary(self):
+        """
+        Get summary of the external calls by their names, the slowest first.
+        """
+        summary = {}
+        for event in self.events:
+            if event['cat'] != 'call':
+                continue
+            calls, total, longest, output = summary.get(event['name'], (0, 0, 0, 0))
+            summary[event['name']] = (calls + 1, total + event['dur'], max(longest, event['dur']),
+                                      output + (event['args'].get('output') or 0))
+
+        table = [('Command', 'Calls', 'Total, s', 'Max, s', 'Output, bytes',)]
+        for name, (calls, total, longest, output) in sorted(summary.items(), key=lambda item: -item[1][1]):
+            table.append((name, calls, "%.3f" % (total / 1000000.), "%.3f" % (longest / 1000000.), output,))
+
+        return TablePrint(table)
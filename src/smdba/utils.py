@@ -27,6 +27,12 @@
 import os
 import grp
 import pwd
+import fcntl
+import csv
+import itertools
+import threading
+import json
+from StringIO import StringIO
 
 
 class TablePrint:
@@ -34,68 +40,336 @@ class TablePrint:
     Print table on the CLI.
     """
 
-    def __init__(self, table):
+    def __init__(self, table, widths=None, sample=None, limit=None):
         """
-        Table is [(1,2,3,), (4,5,6,),] etc data.
+        Table is [(1,2,3,), (4,5,6,),] etc data or an iterator of such rows, header first.
+        Widths of the columns are found from all the rows, unless they are given
+        or sampled from that many first rows. Then rows are streamed as they come,
+        and wider values are not aligned.
+        Limit is the maximal number of rows after the header.
         """
         self.table = table
-        self.widths = []
+        self.widths = widths and list(widths) or []
+        self.sample = sample
+        self.limit = limit
 
 
-    def _check(self):
+    def _get_rows(self):
         """
-        Check if table is consistent grid.
-        Header is a leader here.
+        Rows of the table as tuples of strings. Each value is converted once.
+        Rows are checked for the consistent grid, header is a leader here.
         """
-        if not len(self.table):
-            raise Exception("Table is empty!")
-
         header = None
-        for row in self.table:
-            if header == None:
+        for idx, row in enumerate(self.table):
+            if self.limit is not None and idx > self.limit:
+                break
+            row = tuple([isinstance(value, str) and value or str(value) for value in row])
+            if header is None:
                 header = len(row)
-                continue
-            if len(row) != header:
+            elif len(row) != header:
                 raise Exception("Table has different row widths.")
+            yield row
 
+        if header is None:
+            raise Exception("Table is empty!")
 
-    def _get_widths(self):
+
+    def _get_widths(self, rows):
         """
         Find extra-widths by max width of any value.
         """
+        for row in rows:
+            self.widths = map(max, self.widths or [0] * len(row), map(len, row))
+
+
+    def lines(self):
+        """
+        Format the output line by line.
+        """
+        rows = self._get_rows()
+        if not self.widths:
+            head = list(self.sample is None and rows or itertools.islice(rows, self.sample + 1))
+            self._get_widths(head)
+            rows = itertools.chain(head, rows)
+
+        line = ' | '.join(["%%-%ds" % width for width in self.widths])
+        for idx, row in enumerate(rows):
+            yield line % row
+            if idx == 0:
+                yield '-+-'.join(["-" * width for width in self.widths])
+
+
+    def write(self, stream):
+        """
+        Write the table to the stream without keeping its whole text.
+        """
+        for line in self.lines():
+            stream.write(line + "\n")
+
+
+    def __str__(self):
+        return '\n'.join(self.lines())
+
+
+class Result:
+    """
+    Structured result of a command. Console renders it once as a table, JSON or CSV.
+    """
+
+    FORMATS = ['table', 'json', 'csv']
+
+    # Rows of an iterator, which widths of the table columns are taken from
+    SAMPLE = 1000
+
+    def __init__(self, columns, rows=None, footer=None, record=False):
+        """
+        Columns are (key, label[, format]) tuples, where format is a format string
+        or a function, applied to the raw values in the table only.
+        Footer rows, like totals, are already formatted and displayed only in the table.
+        Record is a single row, displayed as a list of "label: value" lines.
+        """
+        self.columns = [len(column) == 2 and column + (None,) or column for column in columns]
+        self.rows = rows or []
+        self.footer = footer or []
+        self.record = record
+
+
+    def append(self, *row):
+        """
+        Append a row of raw values.
+        """
+        self.rows.append(row)
 
-        self.widths = [0 for x in self.table[0]]
-        for row in self.table:
-            for idx in range(len(row)):
-                cell_len = len(str(row[idx]))
-                if cell_len > self.widths[idx]:
-                    self.widths[idx] = cell_len
+
+    def get_records(self):
+        """
+        Rows as a list of dictionaries by the column keys.
+        """
+        keys = [key for key, label, fmt in self.columns]
+        return [dict(zip(keys, row)) for row in self.rows]
 
 
-    def _format(self):
+    def _format(self, row):
         """
-        Format the output.
+        Format raw values of the row for the table.
         """
         out = []
-        ftable = []
-        for row in self.table:
-            frow = []
-            for idx in range(len(row)):
-                frow.append(str(row[idx]) + (" " * (self.widths[idx] - len(str(row[idx])))))
-            ftable.append(frow)
-
-        for idx in range(len(ftable)):
-            out.append(' | '.join(ftable[idx]))
-            if idx == 0:
-                out.append('-+-'.join(["-" * len(item) for item in ftable[idx]]))
+        for (key, label, fmt), value in zip(self.columns, row):
+            if value is None:
+                value = '--'
+            elif callable(fmt):
+                value = fmt(value)
+            elif fmt:
+                value = fmt % value
+            out.append(value)
 
-        return '\n'.join(out)
+        return tuple(out)
+
+
+    @staticmethod
+    def combine(results):
+        """
+        Combine results of the same command from several databases into one,
+        where each row starts with the database name. Results is a list of
+        (name, result) tuples.
+        """
+        columns = [('cluster', 'Cluster')]
+        for name, result in results:
+            if result is not None:
+                columns.extend(result.columns)
+                break
+        combined = Result(columns)
+        for name, result in results:
+            if result is None:
+                continue
+            if [column[:2] for column in result.columns] != [column[:2] for column in columns[1:]]:
+                raise Exception("Results of different commands cannot be combined.")
+            for row in result.rows:
+                combined.append(name, *row)
+            combined.footer.extend([(name,) + tuple(row) for row in result.footer])
+
+        return combined
+
+
+    def get_rows(self, limit=None, offset=0):
+        """
+        Rows of the page: up to the limit of rows after the offset.
+        """
+        if not limit and not offset:
+            return self.rows
+
+        return itertools.islice(self.rows, offset, limit and offset + limit or None)
+
+
+    def write(self, stream, fmt='table', limit=None, offset=0):
+        """
+        Write the result in the given format to the stream.
+        Rows are streamed one by one to the table and CSV.
+        """
+        if fmt == 'json':
+            keys = [key for key, label, _ in self.columns]
+            records = [dict(zip(keys, row)) for row in self.get_rows(limit, offset)]
+            stream.write(json.dumps(self.record and (records and records[0] or {}) or records, indent=2, sort_keys=True))
+        elif fmt == 'csv':
+            writer = csv.writer(stream, lineterminator="\n")
+            writer.writerow([key for key, label, _ in self.columns])
+            for row in self.get_rows(limit, offset):
+                writer.writerow(['' if value is None else value for value in row])
+            return
+        elif self.record:
+            row = list(itertools.islice(self.rows, 1))
+            width = max([len(label) for key, label, _ in self.columns]) + 2
+            stream.write('\n'.join(["%s:%s%s" % (label, " " * (width - len(label)), value) for (key, label, _), value
+                                    in zip(self.columns, self._format(row and row[0] or [None] * len(self.columns)))]))
+        else:
+            # Iterators are streamed, widths of their columns are taken from the first rows
+            rows = self.get_rows(limit, offset)
+            table = itertools.chain([tuple([label for key, label, _ in self.columns])],
+                                    itertools.imap(self._format, rows),
+                                    self.footer and [tuple([''] * len(self.columns))] + self.footer or [])
+            stream.write("\n")
+            TablePrint(table, sample=not isinstance(self.rows, list) and self.SAMPLE or None).write(stream)
+            if (limit or offset) and isinstance(self.rows, list):
+                if offset < len(self.rows):
+                    stream.write("\nRows %s-%s of %s.\n" % (offset + 1, min(offset + (limit or len(self.rows)), len(self.rows)),
+                                                           len(self.rows)))
+                else:
+                    stream.write("\nNo rows after %s of %s.\n" % (offset, len(self.rows)))
+
+        stream.write("\n")
+
+
+    def render(self, fmt='table', limit=None, offset=0):
+        """
+        Render the result in the given format.
+        """
+        out = StringIO()
+        self.write(out, fmt, limit, offset)
+
+        return out.getvalue().rstrip("\n")
 
 
     def __str__(self):
-        self._check()
-        self._get_widths()
-        return self._format()
+        return self.render()
+
+
+class ThreadOutput:
+    """
+    Output stream, which keeps output of the threads apart, so the threads
+    running at the same time are not mixing their messages. Threads without
+    their own stream are writing to the default one.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        # Thread: (stream, thread which has attached it)
+        self.streams = {}
+
+
+    def attach(self, stream):
+        """
+        Write output of the current thread to the stream.
+        """
+        self.streams[threading.current_thread()] = (stream, threading.current_thread())
+
+
+    def detach(self):
+        """
+        Stop taking output of the current thread and of the threads, it has shared its stream with.
+        """
+        for thread, (stream, owner) in self.streams.items():
+            if owner is threading.current_thread():
+                del self.streams[thread]
+
+
+    def share(self, thread):
+        """
+        Write output of the thread, started by the current one, to the same stream.
+        """
+        if threading.current_thread() in self.streams:
+            self.streams[thread] = self.streams[threading.current_thread()]
+
+
+    def get_stream(self):
+        """
+        Get the stream of the current thread.
+        """
+        return self.streams.get(threading.current_thread(), (self.default, None))[0]
+
+
+    def write(self, data):
+        self.get_stream().write(data)
+
+
+    def __getattr__(self, name):
+        return getattr(self.get_stream(), name)
+
+
+class HostLock:
+    """
+    Host-wide lock of the named group between SMDBA processes.
+    Lock is taken again by the same process without waiting.
+    """
+
+    DIRECTORY = "/var/run"
+
+    # Group name: [file, depth] of the locks, held by this process
+    held = {}
+
+    def __init__(self, name):
+        self.name = name
+        self.path = os.path.join(self.DIRECTORY, "smdba-%s.lock" % name)
+
+
+    def acquire(self, owner=""):
+        """
+        Take the lock without waiting. Returns False, if another process holds it.
+        Owner is a note for the others, like the command name.
+        """
+        if self.name in HostLock.held:
+            HostLock.held[self.name][1] += 1
+            return True
+
+        fh = open(self.path, "a+")
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            fh.close()
+            return False
+
+        fh.seek(0)
+        fh.truncate()
+        fh.write("%s %s\n" % (os.getpid(), owner))
+        fh.flush()
+        HostLock.held[self.name] = [fh, 1]
+
+        return True
+
+
+    def release(self):
+        """
+        Release the lock, once it is released as many times as taken.
+        """
+        lock = HostLock.held.get(self.name)
+        if not lock:
+            return
+
+        lock[1] -= 1
+        if not lock[1]:
+            del HostLock.held[self.name]
+            lock[0].truncate(0)
+            fcntl.flock(lock[0].fileno(), fcntl.LOCK_UN)
+            lock[0].close()
+
+
+    def get_owner(self):
+        """
+        Get PID and the note of the process, which holds the lock.
+        """
+        try:
+            return open(self.path).read().strip()
+        except IOError:
+            return ""
 
 
 def create_dirs(path, owner, mode=0700):
@@ -112,6 +386,33 @@ def create_dirs(path, owner, mode=0700):
     return False
 
 
+def which(name):
+    """
+    Find the executable in the PATH without spawning anything.
+    """
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        executable = os.path.join(path, name)
+        if os.path.isfile(executable) and os.access(executable, os.X_OK):
+            return executable
+
+    return None
+
+
+def get_path_size(path):
+    """
+    Returns the amount of bytes, taken by the files under the path.
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                size += os.lstat(os.path.join(root, fname)).st_size
+            except OSError:
+                pass # File is gone meanwhile
+
+    return size
+
+
 def get_path_owner(path):
     """
     Returns the owner and group IDs of a directory.